@@ -0,0 +1,276 @@
+#!/usr/bin/python
+"""Miriad Source Adder Benchmarks
+
+Usage:
+  miriad-source-adder-benchmark.py [--sizes=<list>] [--pointings=<n>] [--rows=<n>] [--temp-dir=<str>] [--per-pointing]
+
+-h --help                show this
+-s --sizes LIST          the numbers of segments in the synthetic mosaics [default: 10,1000,100000]
+-p --pointings N         the most pointings in a synthetic mosaic [default: 180]
+-r --rows N              the number of uvindex rows in each segment [default: 10]
+-T --temp-dir DIR        do all the work in this directory [default: .]
+-P --per-pointing        benchmark the per-pointing generation mode
+"""
+
+from docopt import docopt
+from datetime import datetime
+import imp
+import os
+import resource
+import sys
+import time
+import types
+import ephem
+
+# The cycle time and number of baselines of the synthetic observations.
+CYCLE_TIME = 10.
+NUM_BASELINES = 15
+
+class StandInMiriad(object):
+    # A stand-in for mirpy's miriad object, so we can benchmark without
+    # Miriad being installed. It pretends to run the tasks the source adder
+    # uses, keeping track of how many records each pretend dataset would
+    # have, and records every call so we can see how much work Miriad would
+    # have been asked to do.
+    def __init__(self):
+        self.filters = {}
+        self.reset("", "")
+
+    def reset(self, uvindex_text, uvlist_array_text):
+        self.uvindex_text = uvindex_text
+        self.uvlist_array_text = uvlist_array_text
+        self.records = {}
+        self.calls = []
+
+    def set_filter(self, funcname, ffunc):
+        self.filters[funcname] = ffunc
+
+    def __getattr__(self, k):
+        task = getattr(self, "task_%s" % k)
+        def func(**kw):
+            (output, records_written) = task(**kw)
+            self.calls.append({ 'task': k, 'records': records_written,
+                                'vis_length': len(kw.get('vis', "")) })
+            # Like mirpy, the filter gets the stripped output.
+            output = output.strip()
+            if (self.filters.get(k) is not None):
+                return self.filters[k](output)
+            return output
+        return func
+
+    def make_dataset(self, name, records):
+        # The source adder checks some datasets exist, so make an empty directory.
+        self.records[name] = records
+        if (not os.path.isdir(name)):
+            os.makedirs(name)
+
+    def dataset_records(self, name):
+        # A dataset the stand-in didn't make itself, such as a segment copied
+        # from the segment cache, is counted as having no records.
+        return self.records.get(name, 0)
+
+    def task_uvindex(self, vis=None, interval=None, log=None):
+        if (log is not None):
+            with open(log, "w") as fp:
+                fp.write(self.uvindex_text)
+            return ("", 0)
+        return (self.uvindex_text, 0)
+
+    def task_uvlist(self, vis=None, options=None, log=None):
+        if (options == "variables,full"):
+            with open(log, "w") as fp:
+                fp.write("inttime  : %.1f\n" % CYCLE_TIME)
+            return ("", 0)
+        return (self.uvlist_array_text, 0)
+
+    def task_uvgen(self, out=None, harange=None, inttime=None, **kw):
+        ha = [ float(h) for h in harange.split(",") ]
+        records = (int((ha[1] - ha[0]) * 3600. / float(inttime)) + 1) * NUM_BASELINES
+        self.make_dataset(out, records)
+        return ("", records)
+
+    def task_uvaver(self, vis=None, select=None, out=None):
+        # The selection looks like time(start,end).
+        times = [ datetime.strptime(t, "%y%b%d:%H:%M:%S") for t in select[5:-1].split(",") ]
+        seconds = (times[1] - times[0]).total_seconds()
+        records = min(self.dataset_records(vis), int(seconds / CYCLE_TIME) * NUM_BASELINES)
+        self.make_dataset(out, records)
+        return ("", records)
+
+    def task_uvcat(self, vis=None, out=None):
+        records = sum([ self.dataset_records(name) for name in vis.split(",") ])
+        self.make_dataset(out, records)
+        return ("", records)
+
+    def task_uvmodel(self, vis=None, model=None, out=None, **kw):
+        self.make_dataset(out, self.dataset_records(model))
+        return ("", self.dataset_records(model))
+
+# The source adder imports mirpy, so the stand-in has to be in place first.
+standin_miriad = StandInMiriad()
+standin_mirpy = types.ModuleType("mirpy")
+standin_mirpy.miriad = standin_miriad
+sys.modules['mirpy'] = standin_mirpy
+
+# The script we're benchmarking has a hyphenated name, so we load it by path.
+adder = imp.load_source("source_adder",
+                        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     "miriad-source-adder.py"))
+
+def date_to_uvindex_time(dt):
+    # Output a date in the format uvindex uses at the start of each line.
+    d = ephem.Date(dt).datetime()
+    return "%s.0" % d.strftime("%y%b%d:%H:%M:%S").upper()
+
+def synthetic_uvindex_lines(num_pointings, num_segments, rows_per_segment,
+                            cycle_time=CYCLE_TIME, start_time="2019/11/05 10:00:00"):
+    # Make the lines uvindex would print for a mosaic which visits each of
+    # the pointings in turn, for rows_per_segment cycles each time.
+    yield "  Summary listing for data-set synthetic.uv"
+    yield ""
+    yield "      Time        Source         Antennas Spectral Wideband Freq   Record"
+    yield "                  Name                   Channels Channels Config No."
+    t = ephem.Date(start_time)
+    record = 1
+    for i in xrange(0, num_segments):
+        name = "mos%04d" % (i % num_pointings)
+        for j in xrange(0, rows_per_segment):
+            yield ("%s %-17s %3d %8d %8d %6d %10d" % (date_to_uvindex_time(t), name, 6, 2049,
+                                                       1, 1, record)).ljust(74)
+            t = ephem.Date(t + cycle_time * ephem.second)
+            record += NUM_BASELINES
+        # Allow some time to slew to the next pointing.
+        t = ephem.Date(t + 5. * ephem.second)
+    yield ("%s Total number of records %d" % (date_to_uvindex_time(t), record)).ljust(74)
+    yield ""
+    yield "  Total observing time is %.2f hours" % (num_segments * rows_per_segment * cycle_time / 3600.)
+    yield ""
+    yield "Frequency Configuration 1"
+    yield "  Nchan  Frequency  Increment  Restfreq  Sideband  IF"
+    yield "   2049    1.33200    0.00050   1.42041         1   1"
+    yield ""
+    yield "------------------------------------------------"
+    yield ""
+    for pol in [ "XX", "YY", "XY", "YX" ]:
+        yield "There are %d records with polarization %s" % (record, pol)
+    yield ""
+    yield "------------------------------------------------"
+    yield ""
+    yield "Source        CalCode  Right Ascension  Declination    dra(arcsec)  ddec(arcsec)"
+    for i in xrange(0, num_pointings):
+        yield "mos%04d       -        22:%02d:%02d.00     -34:52:00.0    0.00         0.00" % (i, (i / 60) % 60, i % 60)
+    yield ""
+
+def synthetic_uvlist_array():
+    # Make the output uvlist options=array,full gives for a six antenna array.
+    lines = [ "Telescope: ATCA", "Latitude: -30:18:46.4", "Longitude: 149:33:00.5",
+              "Antenna ---------- Coordinates" ]
+    for i in xrange(0, 6):
+        lines.append("%d %.4f %.4f %.4f" % ((i + 1), -4752438.4 + 100. * i,
+                                            2790321.1 - 50. * i, -3200483.7))
+    return "\n".join(lines)
+
+class NullWriter(object):
+    # Somewhere to send the source adder's output while we time it.
+    def write(self, s):
+        pass
+
+def timed(function, *args):
+    # Run the function with its output hidden, and return its result and
+    # how long it took.
+    stdout = sys.stdout
+    sys.stdout = NullWriter()
+    try:
+        start_time = time.time()
+        result = function(*args)
+        elapsed = time.time() - start_time
+    finally:
+        sys.stdout = stdout
+    return (result, elapsed)
+
+def parse_uvindex_log(log_name):
+    with open(log_name, "r") as fp:
+        return adder.parse_uvindex(fp)
+
+def summarise_calls(calls):
+    # Add up the calls made to each Miriad task.
+    tasks = {}
+    for call in calls:
+        if (call['task'] not in tasks):
+            tasks[call['task']] = { 'calls': 0, 'records': 0, 'vis_length': 0 }
+        tasks[call['task']]['calls'] += 1
+        tasks[call['task']]['records'] += call['records']
+        tasks[call['task']]['vis_length'] = max(tasks[call['task']]['vis_length'],
+                                                call['vis_length'])
+    return tasks
+
+def benchmark_size(args, num_segments):
+    # Run each stage of the source adder on a synthetic mosaic with
+    # num_segments segments, and time it.
+    num_pointings = min(int(args['--pointings']), num_segments)
+    rows_per_segment = int(args['--rows'])
+    num_rows = num_segments * rows_per_segment
+    uvindex_text = "\n".join(synthetic_uvindex_lines(num_pointings, num_segments, rows_per_segment))
+    standin_miriad.reset(uvindex_text, synthetic_uvlist_array())
+    work_dir = "benchmark_%d" % num_segments
+    if (not os.path.isdir(work_dir)):
+        os.makedirs(work_dir)
+    log_name = "%s/synthetic_uvindex.log" % work_dir
+    with open(log_name, "w") as fp:
+        fp.write(uvindex_text)
+    argv = [ "--ra", "22:45:01.6", "--dec", "-34:52:00", "--flux", "0.8",
+             "--size", "10.0,6.0,90", "--alpha", "-0.7", "--out", "%s/synthetic.mixed" % work_dir,
+             "--temp-dir", work_dir, "--no-cache", "--fresh", "synthetic.uv" ]
+    if (args['--per-pointing']):
+        argv.insert(0, "--per-pointing")
+    adder_args = docopt(adder.__doc__, argv=argv)
+    sources = adder.sources_from_arguments(adder_args)
+    print "%d segments, %d pointings, %d uvindex rows (%.1f MB of uvindex text)" % (num_segments, num_pointings, num_rows,
+                                                                                    len(uvindex_text) / 1048576.)
+
+    timings = []
+    (index_data, elapsed) = timed(parse_uvindex_log, log_name)
+    timings.append(("parse uvindex log", elapsed))
+    (index_data, elapsed) = timed(adder.filter_uvindex, uvindex_text)
+    timings.append(("parse uvindex string", elapsed))
+    (segments, elapsed) = timed(adder.split_into_segments, index_data)
+    timings.append(("split into segments", elapsed))
+    (metadata, elapsed) = timed(adder.get_dataset_metadata, "synthetic.uv")
+    timings.append(("get metadata", elapsed))
+    telescope = adder.make_telescope(metadata['telescope_coordinates'])
+    (plan, elapsed) = timed(adder.plan_generation, adder_args, metadata, telescope)
+    timings.append(("plan generation", elapsed))
+    chop_files = [ "%s/segment_%04d.uvgen" % (work_dir, i) for i in xrange(0, num_segments) ]
+    (levels, elapsed) = timed(adder.plan_uvcat_tree, chop_files, "allsegments.uvgen", work_dir)
+    timings.append(("plan concatenation", elapsed))
+    standin_miriad.calls = []
+    (result, elapsed) = timed(adder.realise_sources, adder_args, metadata, plan, sources,
+                              adder_args['--out'], work_dir)
+    timings.append(("realise sources", elapsed))
+    for (name, elapsed) in timings:
+        print "  %-22s %8.3f s" % (name, elapsed)
+    print "  %d segments found, %d generation groups, %d concatenation levels" % (len(segments), len(plan['groups']),
+                                                                                 len(levels))
+
+    # Summarise what Miriad would have been asked to do.
+    tasks = summarise_calls(standin_miriad.calls)
+    print "  %-10s %8s %16s %12s" % ("Task", "Calls", "Records written", "Longest vis")
+    for name in [ "uvgen", "uvaver", "uvcat", "uvmodel" ]:
+        if (name in tasks):
+            print "  %-10s %8d %16d %12d" % (name, tasks[name]['calls'], tasks[name]['records'],
+                                            tasks[name]['vis_length'])
+    # Each model record should only be copied by uvcat a few times; if this
+    # grows with the number of segments, the concatenation has gone quadratic.
+    if (('uvmodel' in tasks) and (tasks['uvmodel']['records'] > 0)):
+        print "  uvcat copies of each model record: %.2f" % (float(tasks['uvcat']['records']) /
+                                                             tasks['uvmodel']['records'])
+    print "  peak memory use: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__, version="Miriad Source Adder Benchmarks 1.0")
+    if (not os.path.isdir(arguments['--temp-dir'])):
+        os.makedirs(arguments['--temp-dir'])
+    # The source adder puts its uvindex and uvlist logs in the current directory.
+    os.chdir(arguments['--temp-dir'])
+    for size in arguments['--sizes'].split(","):
+        benchmark_size(arguments, int(size))
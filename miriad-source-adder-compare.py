@@ -0,0 +1,184 @@
+#!/usr/bin/python
+"""Miriad Source Adder Engine Comparison
+
+Usage:
+  miriad-source-adder-compare.py [--temp-dir=<str>] [--tolerance=<fraction>]
+
+-h --help                show this
+-T --temp-dir DIR        do all the work in this directory [default: compare]
+-t --tolerance FRACTION  the largest difference between the engines allowed, as a fraction of the flux density [default: 0.01]
+"""
+
+# Check the direct engine against the uvgen engine. We make small datasets
+# with uvgen that have nothing in them, add the same source to them with each
+# engine, and compare the visibilities record by record. This needs Miriad
+# and the aipy Python module.
+
+from docopt import docopt
+import math
+import os
+import shutil
+import subprocess
+import sys
+import numpy as np
+try:
+    from mirpy import miriad
+except (ImportError, OSError):
+    miriad = None
+try:
+    import aipy.miriad
+except ImportError:
+    aipy = None
+
+# The pointing centres the datasets can have.
+PHASE_CENTRE = ("22:45:00.0", "-34:52:00.0")
+EAST_CENTRE = ("22:45:24.0", "-34:52:00.0")
+
+# The cases we check, each with its pointings and the source we add. Each
+# source has a spectral index so its spectrum is tested.
+CASES = [
+    # Offset from the phase centre so the phase of its visibilities is
+    # tested, but close enough that the primary beam hardly matters.
+    { 'name': "near", 'pointings': [ PHASE_CENTRE ],
+      'source': { 'ra': "22:45:01.6", 'dec': "-34:51:40.0", 'flux': 1.0,
+                  'size': "10.0,6.0,45", 'alpha': -0.7 } },
+    # Four arcmin north, where the primary beam takes off almost half of the
+    # flux density, and more in the last channel than in the first.
+    { 'name': "offaxis", 'pointings': [ PHASE_CENTRE ],
+      'source': { 'ra': "22:45:00.0", 'dec': "-34:48:00.0", 'flux': 1.0,
+                  'size': "10.0,6.0,45", 'alpha': -0.7 } },
+    # Two pointings five arcmin apart, observed one after the other, with
+    # the source between them, so each pointing sees it at a different
+    # offset in the primary beam.
+    { 'name': "mosaic", 'pointings': [ PHASE_CENTRE, EAST_CENTRE ],
+      'source': { 'ra': "22:45:14.0", 'dec': "-34:51:00.0", 'flux': 1.0,
+                  'size': "10.0,6.0,45", 'alpha': -0.7 } } ]
+
+# Antennas along an east-west track, like the ATCA's, in metres from the
+# first antenna. The track is along the east direction at the ATCA's longitude.
+LONGITUDE = math.radians(149.550139)
+ANTENNA_EAST = [ 0., 153., 337., 643. ]
+
+def make_empty_dataset(name, temp_dir, pointings):
+    # Use uvgen to make a dataset with a source of no flux density at the
+    # phase centre, and no noise. The hour is shared between the pointings,
+    # which are observed in turn.
+    source_name = "%s/empty_source" % temp_dir
+    with open(source_name, "w") as fp:
+        fp.write("0.000000,0.000,0.000,0.000,0.000,0.000,0,0,0,0.000\n")
+    ant_name = "%s/antennas" % temp_dir
+    with open(ant_name, "w") as fp:
+        for east in ANTENNA_EAST:
+            fp.write("%12.4f %12.4f %12.4f\n" % (-east * math.sin(LONGITUDE),
+                                                 east * math.cos(LONGITUDE), 0.))
+    if (os.path.isdir(name)):
+        shutil.rmtree(name)
+    visit_hours = 1. / len(pointings)
+    visit_names = []
+    for p in xrange(0, len(pointings)):
+        visit_name = "%s/visit_%d.uv" % (temp_dir, p)
+        if (os.path.isdir(visit_name)):
+            shutil.rmtree(visit_name)
+        # The correlator setup is the one the source adder makes from this
+        # dataset's uvindex, so the model channels line up with the real ones.
+        start_ha = -0.5 + p * visit_hours
+        miriad.uvgen(source=source_name, ant=ant_name, baseunit=3.33564, telescop="atca",
+                     corr="64,1,256.000,512.000", freq="5.500,0.0", time="19NOV05:12:00:00",
+                     radec="%s,%s" % pointings[p], harange="%.3f,%.3f" % (start_ha, start_ha + visit_hours - 0.05),
+                     stokes="xx,yy,xy,yx", lat="-30.312889", systemp=0, out=visit_name, inttime=10)
+        # The source adder tells the pointings apart by their names.
+        miriad.puthd(_in="%s/source" % visit_name, value="point%d" % p)
+        visit_names.append(visit_name)
+    miriad.uvcat(vis=",".join(visit_names), out=name)
+
+def add_source(dataset_name, source, out_name, work_dir, engine_arguments):
+    # Run the source adder on the dataset, with the given engine arguments.
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "miriad-source-adder.py")
+    if (os.path.isdir(out_name)):
+        shutil.rmtree(out_name)
+    argv = [ sys.executable, script, "--ra", source['ra'], "--dec", source['dec'],
+             "--flux", str(source['flux']), "--size", source['size'], "--alpha", str(source['alpha']),
+             "--out", out_name, "--temp-dir", work_dir, "--fresh" ] + engine_arguments + [ dataset_name ]
+    print "Running %s" % " ".join(argv[1:])
+    with open("%s.log" % out_name, "w") as fp:
+        status = subprocess.call(argv, stdout=fp, stderr=subprocess.STDOUT)
+    if ((status != 0) or (not os.path.isdir(out_name))):
+        print "ERROR: the source adder failed; see %s.log" % out_name
+        sys.exit(1)
+
+def read_visibilities(dataset_name):
+    # Read the parallel-hand cross-correlations of a dataset, keyed by time,
+    # baseline and polarisation.
+    parallel_pols = [ 1, -1, -2, -5, -6 ]
+    records = {}
+    uv = aipy.miriad.UV(dataset_name)
+    uv.select('auto', 0, 0, include=False)
+    for (preamble, data, flags) in uv.all(raw=True):
+        if (uv['pol'] not in parallel_pols):
+            continue
+        (uvw, t, bl) = preamble
+        records[(round(t * 86400.), bl, uv['pol'])] = (uvw.copy(), data.copy())
+    del(uv)
+    return records
+
+def compare(uvgen_records, direct_records, flux, tolerance):
+    # Compare the records made by each engine, and report how well they agree.
+    # Returns whether they agree within the tolerance.
+    keys = sorted(set(uvgen_records) & set(direct_records))
+    num_unmatched = len(set(uvgen_records) ^ set(direct_records))
+    if (len(keys) == 0):
+        print "ERROR: the two engines made no records in common."
+        return False
+    worst = 0.
+    phase_difference = []
+    first_ratio = []
+    last_ratio = []
+    for key in keys:
+        model_uvgen = uvgen_records[key][1]
+        model_direct = direct_records[key][1]
+        worst = max(worst, np.abs(model_direct - model_uvgen).max() / flux)
+        # On the longest baselines the phase changes by more than a radian
+        # across the source offset, so a wrong sign is obvious here.
+        phase_difference.append(np.angle(model_direct * np.conj(model_uvgen)))
+        if ((np.abs(model_uvgen[0]) > 0.1 * flux) and (np.abs(model_uvgen[-1]) > 0.1 * flux)):
+            first_ratio.append(np.abs(model_direct[0]) / np.abs(model_uvgen[0]))
+            last_ratio.append(np.abs(model_direct[-1]) / np.abs(model_uvgen[-1]))
+    phase_difference = np.degrees(np.abs(np.concatenate(phase_difference)))
+    print "%d records compared, %d records in only one of the datasets" % (len(keys), num_unmatched)
+    print "  worst difference:               %.4f of the flux density" % worst
+    print "  median phase difference:        %.3f degrees" % np.median(phase_difference)
+    print "  worst phase difference:         %.3f degrees" % phase_difference.max()
+    if (len(first_ratio) > 0):
+        # If the spectral index is referred to the wrong frequency, these differ.
+        print "  direct / uvgen amplitude ratio: %.4f in the first channel, %.4f in the last" % (np.median(first_ratio),
+                                                                                                np.median(last_ratio))
+    return ((num_unmatched == 0) and (worst <= tolerance))
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__, version="Miriad Source Adder Engine Comparison 1.0")
+    if ((miriad is None) or (aipy is None)):
+        print "This comparison needs Miriad and the aipy module."
+        sys.exit(1)
+    temp_dir = arguments['--temp-dir']
+    if (not os.path.isdir(temp_dir)):
+        os.makedirs(temp_dir)
+    # The source adder puts its uvindex and uvlist logs in the current directory.
+    os.chdir(temp_dir)
+    failed = []
+    for case in CASES:
+        print "Case %s:" % case['name']
+        empty_name = "%s_empty.uv" % case['name']
+        make_empty_dataset(empty_name, ".", case['pointings'])
+        uvgen_name = "%s_uvgen.uv" % case['name']
+        direct_name = "%s_direct.uv" % case['name']
+        add_source(empty_name, case['source'], uvgen_name, "%s_uvgen_work" % case['name'], [])
+        add_source(empty_name, case['source'], direct_name, "%s_direct_work" % case['name'],
+                   [ "--engine", "direct" ])
+        if (not compare(read_visibilities(uvgen_name), read_visibilities(direct_name),
+                        case['source']['flux'], float(arguments['--tolerance']))):
+            failed.append(case['name'])
+    if (len(failed) == 0):
+        print "PASS: the direct engine agrees with the uvgen engine."
+    else:
+        print "FAIL: the direct engine doesn't agree with the uvgen engine for %s." % ", ".join(failed)
+        sys.exit(1)
@@ -2,7 +2,8 @@
 """Miriad Source Adding Helper
 
 Usage:
-  miriad-source-adder.py [--source-file=<str>] [--ra=<str> ...] [--dec=<str> ...] [--flux=<flux> ...] [--size=<bmaj,bmin,bpa> ...] [--alpha=<alpha> ...] [--out=<str>] [--test] [--temp-dir=<str>] <dataset>
+  miriad-source-adder.py [--source-file=<str>] [--ra=<str> ...] [--dec=<str> ...] [--flux=<flux> ...] [--size=<bmaj,bmin,bpa> ...] [--alpha=<alpha> ...] [--out=<str>] [--test] [--temp-dir=<str>] [--jobs=<n>] [--per-pointing] [--exact-times] [--engine=<str>] [--mixer=<str>] [--mix-memory=<mb>] [--realisations=<file>] [--no-cache] [--show-plan] [--profile] [--fresh] [--segment-cache=<dir>] [--cache-size=<mb>] [--keep-intermediates] [--max-scratch=<mb>] [--stage-dir=<dir>] [--shard=<step>] [--catalogue=<file>] [--source-radius=<arcmin>] [--check-uvw] [--uvw-tolerance=<fraction>] [--pointing-gap=<minutes>] <dataset>...
+  miriad-source-adder.py --listen=<socket>
 
 -h --help                show this
 -s --source-file FILE    file to give to uvgen as "source" parameter
@@ -14,6 +15,29 @@ Usage:
 -o --out OUT             output the mixed dataset with this name
 -t --test                only do a single source uvgen for testing purposes
 -T --temp-dir DIR        put all the intermediate files in this directory [default: .]
+-j --jobs N              generate this many segments at the same time [default: 1]
+-p --per-pointing        run uvgen only once for each pointing, and cut all its segments from that
+-e --exact-times         have uvgen generate only the cycles that were observed
+-E --engine NAME         make the model with "uvgen", or add it "direct"ly to the visibilities [default: uvgen]
+-m --mixer NAME          mix the model in with "uvmodel", or with the "stream"ing mixer [default: uvmodel]
+-M --mix-memory MB       the most memory the streaming mixer can use for model records [default: 256]
+-R --realisations FILE   make a mixed dataset for each set of sources in this file
+-n --no-cache            don't use or save the cached dataset metadata
+-P --show-plan           only print the plan of what would be generated
+-F --profile             record how long each stage takes, and summarise it at the end
+-x --fresh               ignore the manifest of an earlier run, and generate every segment again
+-C --segment-cache DIR   keep the segments in this directory, so later runs can use them again
+-c --cache-size MB       the most disk space the segment cache can use [default: 10240]
+-k --keep-intermediates  don't delete the intermediate datasets once they've been used
+-X --max-scratch MB      only generate as many segments at once as will fit in this much scratch space
+-D --stage-dir DIR       put the intermediate datasets in this (fast, local) directory instead of the temporary directory
+-w --shard STEP          share the generation between machines: "plan" the work, be a "worker", or "merge" the results
+-L --catalogue FILE      add all the sources listed in this file
+-G --source-radius ARCMIN  only add the sources within this distance of each pointing centre
+-u --check-uvw           check each segment matches the times, baselines and uvw of the real dataset as it's made
+-U --uvw-tolerance FRACTION  the largest uvw difference the check allows, as a fraction of the baseline length [default: 0.001]
+-g --pointing-gap MINUTES  with --per-pointing, start a new uvgen call for a pointing that isn't visited for this long [default: 30]
+-l --listen SOCKET       run jobs sent to this Unix socket, keeping what's known about each dataset between them
 """
 
 from docopt import docopt
@@ -23,8 +47,41 @@ import ephem
 from datetime import date, datetime
 import os
 import shutil
+import multiprocessing
+import collections
+import time
+import cPickle as pickle
+import array
+import json
+import hashlib
+import errno
+import socket
+import contextlib
 import numpy as np
 import sys
+try:
+    # The direct engine reads and writes the visibilities with aipy.
+    import aipy.miriad
+except ImportError:
+    aipy = None
+
+# The name of the file we write the profile trace to, if we're profiling.
+profile_trace_name = None
+
+# Change this whenever the format of the dataset metadata changes, so
+# that old cached metadata is not used.
+METADATA_CACHE_VERSION = 2
+
+# The uvw references each process has loaded for checking segments, by file
+# name, along with the modification time and size of the file when it was loaded.
+uvw_reference_cache = {}
+
+# The FWHM at 1 GHz, in arcsec, of the Gaussian primary beam the direct
+# engine uses for each telescope; it scales inversely with frequency. The
+# ATCA's is that of its 22 m dishes, and the others are scaled from it by
+# dish diameter.
+PRIMARY_BEAM_FWHM = { 'atca': 2862., 'askap': 5247., 'meerkat': 4664.,
+                      'vla': 2519., 'wsrt': 2519. }
 
 # A routine to turn a Miriad type time string into a ephem Date.
 def mirtime_to_date(mt):
@@ -61,6 +118,12 @@ def round_date_nsecond(dt, n):
     rt = ephem.date(dt + dd * ephem.second)
     return rt
 
+def truncate_date_second(dt):
+    # Return the date without any fraction of a second, which is the
+    # precision of the Miriad formatted dates we output.
+    d = dt.datetime()
+    return ephem.Date(d.replace(microsecond=0))
+
 def date_to_mirtime(dt):
     # Output a Miriad formatted date.
     d = dt.datetime()
@@ -68,40 +131,77 @@ def date_to_mirtime(dt):
     return rs
 
 
+# A faster version of mirtime_to_date for when there are a lot of times to
+# convert. It returns the ephem date as a plain float, and only works out the
+# date of each day once.
+mirtime_day_cache = {}
+def mirtime_to_days(mt):
+    day = mt[0:7]
+    if (day not in mirtime_day_cache):
+        mirtime_day_cache[day] = float(mirtime_to_date("%s:00:00:00.0" % day))
+    seconds = (int(mt[8:10]) * 3600 + int(mt[11:13]) * 60 +
+               int(round(float(mt[14:18]))))
+    return mirtime_day_cache[day] + seconds / 86400.
+
+def iterate_lines(output):
+    # Go through the lines of a string one at a time, without splitting the
+    # whole string up at once.
+    start = 0
+    while (start <= len(output)):
+        end = output.find('\n', start)
+        if (end < 0):
+            end = len(output)
+        yield output[start:end]
+        start = end + 1
+
 # Use uvindex to work out the necessary parameters of this dataset.
 def filter_uvindex(output):
+    return parse_uvindex(iterate_lines(output))
+
+def parse_uvindex(lines):
+    # Parse the uvindex output, from anything that gives us one line at a
+    # time (like an open log file). The index itself is stored as typed
+    # columns: the times are ephem dates (as floats), the sources are stored
+    # as a code into the list of source names, and the rest are integers.
     # We send back a dictionary.
-    rd = { 'index': { 'time': [], 'source': [], 'calcode': [], 'antennas': [],
-                      'spectral_channels': [], 'wideband_channels': [], 'freq_config': [],
-                      'record_number': [] },
+    rd = { 'index': { 'time': array.array('d'), 'source_code': array.array('i'),
+                      'source_names': [], 'calcode': array.array('c'),
+                      'antennas': array.array('i'), 'spectral_channels': array.array('i'),
+                      'wideband_channels': array.array('i'), 'freq_config': array.array('i'),
+                      'record_number': array.array('i') },
            'total_time': 0,
            'freq_configs': [], 'polarisations': [], 'sources': [] }
-    outlines = output.split('\n')
+    index = rd['index']
+    source_codes = {}
     section = 0
     freqconfig_n = 0
     freqconfig_found = 0
     fc = None
     sourcearea = 0
-    for i in xrange(0, len(outlines)):
-        index_elements = outlines[i].split()
-        if ((section == 0) and (len(outlines[i]) >= 74)):
-            indexTime = mirtime_to_date(outlines[i][0:18])
+    for line in lines:
+        line = line.rstrip('\r\n')
+        index_elements = line.split()
+        if ((section == 0) and (len(line) >= 74)):
             if ((index_elements[1] != "Total") and (index_elements[2] != "number")):
                 # This is a regular line.
                 offset = 0
-                rd['index']['time'].append(indexTime)
-                rd['index']['source'].append(index_elements[1])
+                index['time'].append(mirtime_to_days(line[0:18]))
+                source_name = index_elements[1]
+                if (source_name not in source_codes):
+                    source_codes[source_name] = len(index['source_names'])
+                    index['source_names'].append(source_name)
+                index['source_code'].append(source_codes[source_name])
                 # Check if we have a calibrator code.
-                calcode = outlines[i][36:37]
+                calcode = line[36:37]
                 if (calcode == " "):
                     # No calibrator code.
                     offset = 1
-                rd['index']['calcode'].append(calcode)
-                rd['index']['antennas'].append(int(index_elements[3 - offset]))
-                rd['index']['spectral_channels'].append(int(index_elements[4 - offset]))
-                rd['index']['wideband_channels'].append(int(index_elements[5 - offset]))
-                rd['index']['freq_config'].append(int(index_elements[6 - offset]))
-                rd['index']['record_number'].append(int(index_elements[7 - offset]))
+                index['calcode'].append(calcode)
+                index['antennas'].append(int(index_elements[3 - offset]))
+                index['spectral_channels'].append(int(index_elements[4 - offset]))
+                index['wideband_channels'].append(int(index_elements[5 - offset]))
+                index['freq_config'].append(int(index_elements[6 - offset]))
+                index['record_number'].append(int(index_elements[7 - offset]))
             else:
                 # We've moved to the next section
                 section = 1
@@ -123,7 +223,7 @@ def filter_uvindex(output):
             elif (freqconfig_found == 1):
                 freqconfig_found = 2
             elif (freqconfig_found == 2):
-                if (outlines[i] == ""):
+                if (line == ""):
                     freqconfig_found = 0
                 else:
                     # This is the actual line.
@@ -132,7 +232,7 @@ def filter_uvindex(output):
                     fc['frequency_increment'].append(float(index_elements[2]))
                     fc['rest_frequency'].append(float(index_elements[3]))
                     fc['ifchain'].append(int(index_elements[5]))
-            elif (outlines[i] == "------------------------------------------------"):
+            elif (line == "------------------------------------------------"):
                 if (fc is not None):
                     rd['freq_configs'].append(fc)
                 section = 3
@@ -140,7 +240,7 @@ def filter_uvindex(output):
             if ((len(index_elements) > 0) and (index_elements[0] == "There") and
                 (index_elements[3] == "records") and (index_elements[5] == "polarization")):
                 rd['polarisations'].append(index_elements[6])
-            elif (outlines[i] == "------------------------------------------------"):
+            elif (line == "------------------------------------------------"):
                 section = 4
         elif (section == 4):
             if ((len(index_elements) > 0) and (index_elements[0] == "Source")):
@@ -151,15 +251,13 @@ def filter_uvindex(output):
                         'dra': index_elements[4], 'ddec': index_elements[5] }
                 rd['sources'].append(src)
 
-    # Convert things into numpy arrays for easy where-ing later.
-    rd['index']['time'] = np.array(rd['index']['time'])
-    rd['index']['source'] = np.array(rd['index']['source'])
-    rd['index']['calcode'] = np.array(rd['index']['calcode'])
-    rd['index']['antennas'] = np.array(rd['index']['antennas'])
-    rd['index']['spectral_channels'] = np.array(rd['index']['spectral_channels'])
-    rd['index']['wideband_channels'] = np.array(rd['index']['wideband_channels'])
-    rd['index']['freq_config'] = np.array(rd['index']['freq_config'])
-    rd['index']['record_number'] = np.array(rd['index']['record_number'])
+    # Convert the columns into numpy arrays for easy where-ing later.
+    index['time'] = np.frombuffer(index['time'], dtype=np.float64).copy()
+    index['source_code'] = np.frombuffer(index['source_code'], dtype=np.intc).copy()
+    index['calcode'] = np.frombuffer(index['calcode'], dtype='S1').copy()
+    for column in [ 'antennas', 'spectral_channels', 'wideband_channels',
+                    'freq_config', 'record_number' ]:
+        index[column] = np.frombuffer(index[column], dtype=np.intc).copy()
     
     return rd
 
@@ -199,6 +297,36 @@ def filter_uvlist_variables(logfile_name):
             rd['cycle_time'] = float(index_elements[2])
     return rd
 
+def cycle_hour_angle_range(start_time, end_time, transit_time, cycle_time):
+    # Work out the hour angles, relative to the transit time, of the centres
+    # of the first and last cycles in the time range. A generation over
+    # this range produces only the cycles that were actually observed.
+    sidereal_modifier = 1.00273790935
+    first_cycle = round_date_nsecond(ephem.Date(start_time), cycle_time)
+    last_cycle = round_date_nsecond(ephem.Date(end_time), cycle_time)
+    start_ha = (first_cycle - transit_time) * 24. * sidereal_modifier
+    finish_ha = (last_cycle - transit_time) * 24. * sidereal_modifier
+    # Pad the end by a quarter of a cycle so the last cycle isn't lost
+    # to rounding.
+    finish_ha += (cycle_time / 4.) / 3600. * sidereal_modifier
+    return (start_ha, finish_ha)
+
+def hour_angles(observer, ra_hours, times):
+    # Work out the hour angles (in hours, between -12 and 12) of the right
+    # ascensions ra_hours (in hours) at the ephem dates in times, all as
+    # arrays. pyephem only gives us the sidereal time once, and from there it
+    # advances at the sidereal rate.
+    sidereal_modifier = 1.00273790935
+    times = np.asarray(times, dtype=float)
+    if (len(times) == 0):
+        return np.zeros(0)
+    reference_time = times.min()
+    observer.date = ephem.Date(reference_time)
+    reference_lst = observer.sidereal_time() * 12. / math.pi
+    lst = reference_lst + (times - reference_time) * 24. * sidereal_modifier
+    hour_angle = np.mod(lst - np.asarray(ra_hours) + 12., 24.) - 12.
+    return hour_angle
+
 def get_hour_angle(source, observer):
     source.compute(observer)
     hour_angle = (observer.sidereal_time() - source._ra) * 180. / (math.pi * 15.)
@@ -220,46 +348,87 @@ def output_antenna_file(location, filename):
 
 def split_into_segments(idx):
     # We go through a uvindex dictionary and return segments.
-    # Each segment is a single source, with a start and end time.
+    # Each segment is a single source observed with a single frequency
+    # configuration, with a start and end time.
+    codes = idx['index']['source_code']
+    names = idx['index']['source_names']
+    times = idx['index']['time']
+    configs = idx['index']['freq_config']
+    if (len(codes) == 0):
+        return []
+    # A new segment starts wherever the source or frequency configuration changes.
+    changes = np.flatnonzero((codes[1:] != codes[:-1]) | (configs[1:] != configs[:-1])) + 1
+    starts = np.concatenate(([ 0 ], changes))
+    ends = np.concatenate((changes - 1, [ len(codes) - 1 ]))
     segs = []
-    oldsrc = ""
-    sseg = None
-    for i in xrange(0, len(idx['index']['source'])):
-        if (idx['index']['source'][i] != oldsrc):
-            if (oldsrc != ""):
-                # Put the segment on the list.
-                segs.append(sseg)
-            oldsrc = idx['index']['source'][i]
-            sseg = { 'source': idx['index']['source'][i],
-                     'start_time': ephem.Date(idx['index']['time'][i]),
-                     'end_time': ephem.Date(idx['index']['time'][i]) }
-        else:
-            sseg['end_time'] = idx['index']['time'][i]
-    # Have to push the last segment on.
-    segs.append(sseg)
+    for i in xrange(0, len(starts)):
+        segs.append({ 'source': names[codes[starts[i]]],
+                      'freq_config': int(configs[starts[i]]),
+                      'start_time': ephem.Date(times[starts[i]]),
+                      'end_time': ephem.Date(times[ends[i]]) })
     return segs
 
-def add_uvcat(fileString, newFile, outdir):
-    # Keep adding files to the uvcat input string until it gets too long
-    # and then do the uvcat.
-    lfs = len(fileString)
-    lnf = len(newFile)
-    maxlen = 950
-    if ((lfs + lnf + 1) < maxlen):
-        # Easy, just append the string.
-        return "%s,%s" % (fileString, newFile)
-    # Otherwise we do the uvcat.
-    files = fileString.split(",")
-    ohead, otail = os.path.split(files[0])
-    outFile = "%s/uvc_%s" % (outdir, otail)
+def split_uvcat_batches(files, maxlen):
+    # Split the list of files into as few batches as possible, each of
+    # which has a uvcat input string shorter than maxlen. The batches are
+    # contiguous, to keep the time order, and are made of as equal a size
+    # as possible.
+    totlen = len(",".join(files))
+    nbatches = max(1, int(math.ceil(totlen / float(maxlen))))
+    while True:
+        size = int(math.ceil(len(files) / float(nbatches)))
+        batches = [ files[i:(i + size)] for i in xrange(0, len(files), size) ]
+        if ((size == 1) or
+            (max([ len(",".join(batch)) for batch in batches ]) < maxlen)):
+            return batches
+        nbatches += 1
+
+def plan_uvcat_tree(files, outFile, outdir, maxlen=950):
+    # Work out how to concatenate the files into outFile with uvcat, given
+    # that there is a limit to the length of the string uvcat can take. The
+    # files are merged in a balanced tree, so each visibility is copied only
+    # a few times. We return a list of levels, and each level is a list of
+    # (input files, output file) merges that can all be run at once.
+    levels = []
+    current = files
+    level = 0
+    while True:
+        batches = split_uvcat_batches(current, maxlen)
+        if (len(batches) == 1):
+            levels.append([ (batches[0], outFile) ])
+            return levels
+        merges = []
+        for i in xrange(0, len(batches)):
+            merges.append((batches[i], "%s/uvc_%d_%04d" % (outdir, level, i)))
+        levels.append(merges)
+        current = [ merge[1] for merge in merges ]
+        level += 1
+
+def uvcat_merge(merge):
+    # Run uvcat for a single (input files, output file, cleanup) merge. If
+    # cleanup is True, the input files are deleted once they've been merged.
+    (inFiles, outFile, cleanup) = merge
     if (os.path.isdir(outFile)):
         shutil.rmtree(outFile)
-    print "  Concatenating intermediate product"
-    #print "[%s]" % fileString
-    miriad.uvcat(vis=fileString, out=outFile)
-    # Now add the new file to this.
-    rv = add_uvcat(outFile, newFile, outdir)
-    return rv
+    run_miriad('uvcat', vis=",".join(inFiles), out=outFile)
+    if cleanup:
+        for inFile in inFiles:
+            shutil.rmtree(inFile)
+    return outFile
+
+def concatenate_files(files, outFile, outdir, jobs, cleanup=False):
+    # Concatenate the files, in order, into outFile. If cleanup is True, the
+    # files and the intermediate products are deleted as soon as they've been
+    # merged.
+    levels = plan_uvcat_tree(files, outFile, outdir)
+    for i in xrange(0, len(levels)):
+        if (i < (len(levels) - 1)):
+            print "  Concatenating %d intermediate products" % len(levels[i])
+        else:
+            print "  Concatenating final product"
+        run_tasks(uvcat_merge, [ (inFiles, mergeFile, cleanup) for (inFiles, mergeFile) in levels[i] ],
+                  jobs)
+    return outFile
 
 def stringToFloat(s):
     # Take a sexagesimal string and return the float value.
@@ -277,11 +446,823 @@ def stringToFloat(s):
         val = val * -1.
     return val
 
-def add_source(args):
-    # Let's create a uvindex of the dataset first.
-    dataset_name = args['<dataset>']
-    miriad.set_filter('uvindex', filter_uvindex)
-    index_data = miriad.uvindex(vis=dataset_name, interval="0.1")
+def profile_start():
+    # Note the wall and CPU times at the start of a stage we're profiling.
+    return (time.time(), os.times())
+
+def dataset_size(name):
+    # The total size in bytes of a dataset (or any other file).
+    if (name is None):
+        return None
+    if (os.path.isfile(name)):
+        return os.path.getsize(name)
+    if (not os.path.isdir(name)):
+        return None
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(name):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+def profile_record(stage, start, segment=None, out=None):
+    # Add a record of a stage to the profile trace, if we're profiling. The
+    # CPU time includes any Miriad tasks that were run during the stage.
+    if (profile_trace_name is None):
+        return
+    (start_wall, start_cpu) = start
+    end_cpu = os.times()
+    record = { 'stage': stage, 'segment': segment, 'pid': os.getpid(),
+               'start': start_wall, 'wall': time.time() - start_wall,
+               'cpu': sum(end_cpu[0:4]) - sum(start_cpu[0:4]),
+               'out': out, 'out_bytes': dataset_size(out) }
+    # Each record is a single short write, so records from parallel workers
+    # don't get mixed up.
+    with open(profile_trace_name, "a") as fp:
+        fp.write("%s\n" % json.dumps(record))
+
+@contextlib.contextmanager
+def profile_stage(stage, segment=None, out=None):
+    # Profile everything done inside a with block.
+    start = profile_start()
+    yield
+    profile_record(stage, start, segment=segment, out=out)
+
+def run_miriad(task, segment=None, **kwargs):
+    # Run a Miriad task through mirpy, and profile it.
+    start = profile_start()
+    result = getattr(miriad, task)(**kwargs)
+    profile_record(task, start, segment=segment, out=kwargs.get('out'))
+    return result
+
+def print_profile_summary(trace_name):
+    # Summarise the profile trace, with the stages that took the most time first.
+    stages = {}
+    with open(trace_name, "r") as fp:
+        for line in fp:
+            record = json.loads(line)
+            if (record['stage'] not in stages):
+                stages[record['stage']] = { 'calls': 0, 'wall': 0., 'cpu': 0., 'out_bytes': 0 }
+            stage = stages[record['stage']]
+            stage['calls'] += 1
+            stage['wall'] += record['wall']
+            stage['cpu'] += record['cpu']
+            if (record['out_bytes'] is not None):
+                stage['out_bytes'] += record['out_bytes']
+    print "Profile summary (the full trace is in %s):" % trace_name
+    print "  %-14s %7s %12s %12s %12s %12s" % ("Stage", "Calls", "Wall (s)", "CPU (s)",
+                                               "Mean wall", "Output (MB)")
+    for name in sorted(stages, key=lambda n: stages[n]['wall'], reverse=True):
+        stage = stages[name]
+        print "  %-14s %7d %12.2f %12.2f %12.3f %12.1f" % (name, stage['calls'], stage['wall'], stage['cpu'],
+                                                           stage['wall'] / stage['calls'],
+                                                           stage['out_bytes'] / 1048576.)
+
+def sources_from_arguments(args):
+    # Make a list of the sources to add from the command line arguments.
+    sources = []
+    for j in xrange(0, len(args['--ra'])):
+        # The source size.
+        szel = args['--size'][j].split(",")
+        if (len(szel) != 3):
+            print "ERROR: the size of source %d was not correctly specified" % (j + 1)
+            sys.exit()
+        sources.append({ 'ra': args['--ra'][j], 'dec': args['--dec'][j],
+                         'flux': float(args['--flux'][j]), # in Jy
+                         'bmaj': float(szel[0]), 'bmin': float(szel[1]),
+                         'bpa': float(szel[2]),
+                         'alpha': float(args['--alpha'][j]) })
+    return sources
+
+def source_positions(sources):
+    # Return arrays of the right ascensions and declinations of the sources,
+    # in degrees.
+    ra = np.array([ 15. * stringToFloat(src['ra']) for src in sources ])
+    dec = np.array([ stringToFloat(src['dec']) for src in sources ])
+    return (ra, dec)
+
+def source_file_lines(sources, positions, sourceRa, sourceDec, selected=None):
+    # Make the lines of a uvgen source file for a pointing centred at
+    # sourceRa, sourceDec (both in degrees), where positions are the
+    # source positions from source_positions. uvgen needs the positions
+    # as offsets from the pointing centre, in arcseconds. If selected is
+    # given, only the sources with those indices are included.
+    if (selected is None):
+        selected = np.arange(0, len(sources))
+    if (len(selected) == 0):
+        # uvgen needs at least one source, so give it one with no flux density.
+        return [ "0.000000,0.000,0.000,0.000,0.000,0.000,0,0,0,0.000" ]
+    nsourceRa = positions[0][selected]
+    nsourceDec = positions[1][selected]
+    avdec = ((nsourceDec + sourceDec) / 2.) * (math.pi / 180.)
+    dra = (nsourceRa - sourceRa) * 3600. * np.cos(avdec)
+    ddec = (nsourceDec - sourceDec) * 3600.
+    src_lines = []
+    for j in xrange(0, len(selected)):
+        src = sources[selected[j]]
+        src_lines.append("%.6f,%.3f,%.3f,%.3f,%.3f,%.3f,0,0,0,%.3f" % (src['flux'], dra[j], ddec[j],
+                                                                       src['bmaj'], src['bmin'],
+                                                                       src['bpa'], src['alpha']))
+    return src_lines
+
+def index_sources(positions, radius):
+    # Make a spatial index of the source positions (in degrees) from
+    # source_positions, so we can quickly find the sources within radius
+    # degrees of each pointing. The sky is cut into bands of declination
+    # radius degrees high, and the sources in each band are sorted by right
+    # ascension.
+    (ra, dec) = positions
+    band = np.floor((dec + 90.) / radius).astype(int)
+    bands = {}
+    for b in np.unique(band):
+        members = np.where(band == b)[0]
+        order = np.argsort(ra[members])
+        bands[b] = (ra[members][order], members[order])
+    return { 'radius': radius, 'bands': bands, 'ra': ra, 'dec': dec }
+
+def sources_near(index, ra0, dec0):
+    # Find the indices of the sources in the index within its radius of
+    # ra0, dec0 (in degrees), in ascending order.
+    radius = index['radius']
+    # How far in right ascension we need to look, which is furthest on the
+    # side of the circle closest to the pole.
+    pole_dec = abs(dec0) + radius
+    half_width = 180.
+    if (pole_dec < 90.):
+        half_width = min(180., radius / math.cos(pole_dec * math.pi / 180.))
+    if (half_width >= 180.):
+        ra_ranges = [ (0., 360.) ]
+    elif ((ra0 - half_width) < 0.):
+        ra_ranges = [ (0., ra0 + half_width), (ra0 - half_width + 360., 360.) ]
+    elif ((ra0 + half_width) >= 360.):
+        ra_ranges = [ (ra0 - half_width, 360.), (0., ra0 + half_width - 360.) ]
+    else:
+        ra_ranges = [ (ra0 - half_width, ra0 + half_width) ]
+    candidates = []
+    for b in xrange(int(math.floor((dec0 - radius + 90.) / radius)),
+                    int(math.floor((dec0 + radius + 90.) / radius)) + 1):
+        if (b not in index['bands']):
+            continue
+        (band_ra, members) = index['bands'][b]
+        for (ra_low, ra_high) in ra_ranges:
+            candidates.append(members[np.searchsorted(band_ra, ra_low, side="left"):
+                                      np.searchsorted(band_ra, ra_high, side="right")])
+    if (len(candidates) == 0):
+        return np.array([], dtype=int)
+    candidates = np.unique(np.concatenate(candidates))
+    # Now the exact distances, using the haversine formula.
+    d2r = math.pi / 180.
+    cra = index['ra'][candidates] * d2r
+    cdec = index['dec'][candidates] * d2r
+    hav = (np.sin((cdec - dec0 * d2r) / 2.)**2 +
+           np.cos(cdec) * math.cos(dec0 * d2r) * np.sin((cra - ra0 * d2r) / 2.)**2)
+    distance = 2. * np.arcsin(np.sqrt(np.minimum(hav, 1.))) / d2r
+    return candidates[distance <= radius]
+
+def read_source_file(filename):
+    # Read a uvgen source file, and return its components. The positions in
+    # these files are offsets from the pointing centre, in arcseconds.
+    components = []
+    with open(filename, "r") as fp:
+        lines = fp.readlines()
+    for i in xrange(0, len(lines)):
+        line = lines[i].split("#")[0].strip()
+        if (line == ""):
+            continue
+        els = line.split(",")
+        alpha = 0.
+        if (len(els) > 9):
+            alpha = float(els[9])
+        components.append({ 'flux': float(els[0]), 'dra': float(els[1]),
+                            'ddec': float(els[2]), 'bmaj': float(els[3]),
+                            'bmin': float(els[4]), 'bpa': float(els[5]),
+                            'alpha': alpha })
+    return components
+
+def component_arrays(components, ra0, dec0, radius=None):
+    # Make arrays of the component parameters, with the positions as
+    # direction cosines relative to the phase centre ra0, dec0 (radians),
+    # along with the distance (radians) of each from the phase centre. If
+    # radius (radians) is given, only the components within it are included.
+    arcsec = math.pi / (180. * 3600.)
+    comps = { 'flux': [], 'l': [], 'm': [], 'distance': [], 'bmaj': [], 'bmin': [],
+              'bpa': [], 'alpha': [] }
+    for i in xrange(0, len(components)):
+        if ('dra' in components[i]):
+            # This is an offset from whichever pointing we're at.
+            l = components[i]['dra'] * arcsec
+            m = components[i]['ddec'] * arcsec
+            distance = math.sqrt(l ** 2 + m ** 2)
+        else:
+            ra = math.radians(15. * stringToFloat(components[i]['ra']))
+            dec = math.radians(stringToFloat(components[i]['dec']))
+            l = math.cos(dec) * math.sin(ra - ra0)
+            m = (math.sin(dec) * math.cos(dec0) -
+                 math.cos(dec) * math.sin(dec0) * math.cos(ra - ra0))
+            distance = math.acos(max(-1., min(1., math.sin(dec) * math.sin(dec0) +
+                                               math.cos(dec) * math.cos(dec0) * math.cos(ra - ra0))))
+        if ((radius is not None) and (distance > radius)):
+            continue
+        comps['flux'].append(components[i]['flux'])
+        comps['l'].append(l)
+        comps['m'].append(m)
+        comps['distance'].append(distance)
+        comps['bmaj'].append(components[i]['bmaj'] * arcsec)
+        comps['bmin'].append(components[i]['bmin'] * arcsec)
+        comps['bpa'].append(math.radians(components[i]['bpa']))
+        comps['alpha'].append(components[i]['alpha'])
+    for k in comps:
+        comps[k] = np.array(comps[k])[:, np.newaxis]
+    return comps
+
+def model_visibilities(comps, uvw, freqs, ref_freq, pb_fwhm=None):
+    # Evaluate the sum of the Gaussian components at each frequency (GHz)
+    # for a baseline with coordinates uvw (in ns), attenuated by a Gaussian
+    # primary beam with FWHM pb_fwhm (radians) at 1 GHz if it's given. The
+    # result is an array with one complex visibility per channel.
+    u = uvw[0] * freqs[np.newaxis, :]
+    v = uvw[1] * freqs[np.newaxis, :]
+    # The uv distance along the major and minor axes of each component,
+    # where the position angle is measured from north through east.
+    umaj = u * np.sin(comps['bpa']) + v * np.cos(comps['bpa'])
+    umin = u * np.cos(comps['bpa']) - v * np.sin(comps['bpa'])
+    envelope = np.exp(-(math.pi ** 2 / (4. * math.log(2.))) *
+                      ((comps['bmaj'] * umaj) ** 2 + (comps['bmin'] * umin) ** 2))
+    spectrum = comps['flux'] * (freqs[np.newaxis, :] / ref_freq) ** comps['alpha']
+    if (pb_fwhm is not None):
+        spectrum = spectrum * np.exp(-4. * math.log(2.) *
+                                     (comps['distance'] * freqs[np.newaxis, :] / pb_fwhm) ** 2)
+    phase = -2. * math.pi * (u * comps['l'] + v * comps['m'])
+    vis = spectrum * envelope * np.exp(1j * phase)
+    return vis.sum(axis=0).astype(np.complex64)
+
+def record_frequencies(uv):
+    # Return the frequency (GHz) of each channel of the current record.
+    sfreq = np.atleast_1d(uv['sfreq'])
+    sdf = np.atleast_1d(uv['sdf'])
+    nschan = np.atleast_1d(uv['nschan'])
+    freqs = []
+    for i in xrange(0, len(nschan)):
+        freqs.append(sfreq[i] + sdf[i] * np.arange(nschan[i]))
+    return np.concatenate(freqs)
+
+def direct_mix(dataset_name, components, out_name, radius=None):
+    # Add the components to each record of the real dataset, writing the
+    # result to out_name. The model is evaluated on the uvw coordinates of
+    # each record, so it can't fail to match. Like uvgen, the components
+    # are attenuated by the primary beam of the record's pointing, and if
+    # radius (radians) is given, only the components within it are added.
+    uvi = aipy.miriad.UV(dataset_name)
+    # uvmodel would only output the cross-correlations, and so do we.
+    uvi.select('auto', 0, 0, include=False)
+    # The spectral indices are relative to the first channel of the
+    # dataset, as in the uvgen source file.
+    ref_freq = record_frequencies(uvi)[0]
+    telescope = ""
+    if ('telescop' in uvi.vartable):
+        telescope = uvi['telescop'].strip().lower()
+    pb_fwhm = None
+    if (telescope in PRIMARY_BEAM_FWHM):
+        pb_fwhm = math.radians(PRIMARY_BEAM_FWHM[telescope] / 3600.)
+    else:
+        print "WARNING: the primary beam of telescope '%s' is not known, so the sources will not be attenuated." % telescope
+    if (os.path.isdir(out_name)):
+        shutil.rmtree(out_name)
+    uvo = aipy.miriad.UV(out_name, status='new')
+    uvo.init_from_uv(uvi)
+
+    # Polarisations which get the total intensity of an unpolarised source;
+    # the cross-hand polarisations get nothing.
+    parallel_pols = [ 1, -1, -2, -5, -6 ]
+    # Each pointing has its own component positions, and each baseline and
+    # time is usually seen in more than one polarisation, so we keep the
+    # last things we worked out.
+    cache = { 'pointing': None, 'comps': None, 'record': None, 'model': None }
+    def add_model(uv, preamble, data, flags):
+        if (uv['pol'] not in parallel_pols):
+            return preamble, data, flags
+        pointing = (uv['ra'], uv['dec'])
+        if (pointing != cache['pointing']):
+            cache['pointing'] = pointing
+            cache['comps'] = component_arrays(components, pointing[0], pointing[1], radius)
+            cache['record'] = None
+        (uvw, t, bl) = preamble
+        record = (t, bl, tuple(uvw))
+        if (record != cache['record']):
+            cache['record'] = record
+            cache['model'] = model_visibilities(cache['comps'], uvw,
+                                                record_frequencies(uv), ref_freq, pb_fwhm)
+        return preamble, data + cache['model'], flags
+
+    print "  Adding the model directly to the visibilities."
+    uvo.pipe(uvi, mfunc=add_model, raw=True,
+             append2hist="miriad-source-adder.py: added sources with the direct engine\n")
+    del(uvo)
+
+def iterate_model_records(files):
+    # Read through the records of each of the model datasets in turn.
+    for i in xrange(0, len(files)):
+        uv = aipy.miriad.UV(files[i])
+        for (preamble, data, flags) in uv.all(raw=True):
+            yield (preamble[1], preamble[2], uv['pol'], data.copy())
+        del(uv)
+
+def stream_mix(dataset_name, model_files, out_name, cycle_time, memory_mb):
+    # Add the model datasets to the real dataset, like uvmodel would, but
+    # reading the model datasets directly in order and keeping only a
+    # limited number of model records in memory at once. Both the real
+    # dataset and the models are in time order, so we only need to keep the
+    # model records near the time of the record we're up to.
+    uvi = aipy.miriad.UV(dataset_name)
+    uvi.select('auto', 0, 0, include=False)
+    if (os.path.isdir(out_name)):
+        shutil.rmtree(out_name)
+    uvo = aipy.miriad.UV(out_name, status='new')
+    uvo.init_from_uv(uvi)
+
+    # The model records for each baseline and polarisation, in time order.
+    # The times in the model may differ from the real times by up to half a
+    # cycle (see the README for why), and times are in days.
+    tolerance = (cycle_time / 2.) / 86400.
+    memory_bytes = memory_mb * 1024. * 1024.
+    state = { 'buffer': {}, 'nbytes': 0, 'last_time': None,
+              'exhausted': False, 'purge_time': None, 'unmatched': 0 }
+    model_records = iterate_model_records(model_files)
+    def add_model(uv, preamble, data, flags):
+        (uvw, t, bl) = preamble
+        # Read the model until we're past the time of this record.
+        while ((not state['exhausted']) and
+               ((state['last_time'] is None) or (state['last_time'] <= (t + tolerance)))):
+            try:
+                (mt, mbl, mpol, mdata) = model_records.next()
+            except StopIteration:
+                state['exhausted'] = True
+                break
+            key = (mbl, mpol)
+            if (key not in state['buffer']):
+                state['buffer'][key] = collections.deque()
+            state['buffer'][key].append((mt, mdata))
+            state['nbytes'] += mdata.nbytes
+            state['last_time'] = mt
+            if (state['nbytes'] > memory_bytes):
+                print "ERROR: the model records needed at time %s don't fit in %.1f MB." % (ephem.Date(t - 2415020), memory_mb)
+                print "       Increase --mix-memory and try again."
+                sys.exit()
+        # Throw away any model records we've gone past.
+        if (state['purge_time'] != t):
+            state['purge_time'] = t
+            for key in state['buffer']:
+                dq = state['buffer'][key]
+                while ((len(dq) > 0) and (dq[0][0] < (t - tolerance))):
+                    state['nbytes'] -= dq[0][1].nbytes
+                    dq.popleft()
+        dq = state['buffer'].get((bl, uv['pol']))
+        if ((dq is None) or (len(dq) == 0) or (abs(dq[0][0] - t) > tolerance)):
+            state['unmatched'] += 1
+            return preamble, data, flags
+        (mt, mdata) = dq.popleft()
+        state['nbytes'] -= mdata.nbytes
+        return preamble, data + mdata, flags
+
+    uvo.pipe(uvi, mfunc=add_model, raw=True,
+             append2hist="miriad-source-adder.py: added the model with the streaming mixer\n")
+    del(uvo)
+    if (state['unmatched'] > 0):
+        print "WARNING: %d records of the real dataset had no matching model record." % state['unmatched']
+
+class ModelMismatchError(Exception):
+    # A generated segment doesn't match the real dataset.
+    pass
+
+def read_record_coordinates(dataset_name):
+    # Read the time (JD), baseline number and uvw (ns) of each of the
+    # cross-correlation records of a dataset, once for each time and baseline.
+    uv = aipy.miriad.UV(dataset_name)
+    uv.select('auto', 0, 0, include=False)
+    times = array.array('d')
+    baselines = array.array('i')
+    uvws = array.array('d')
+    last = None
+    for (preamble, data, flags) in uv.all(raw=True):
+        (uvw, t, bl) = preamble
+        if ((t, bl) == last):
+            # Another polarisation of the same record.
+            continue
+        last = (t, bl)
+        times.append(t)
+        baselines.append(int(bl))
+        uvws.extend(uvw)
+    del(uv)
+    return (np.frombuffer(times, dtype=np.float64).copy(),
+            np.frombuffer(baselines, dtype=np.intc).copy(),
+            np.frombuffer(uvws, dtype=np.float64).copy().reshape(-1, 3))
+
+def index_record_coordinates(times, baselines, uvws):
+    # Sort the records by baseline and then time, as a single key that keeps
+    # the baselines apart, so that matching records can be found with a
+    # binary search.
+    (unique_baselines, rank) = np.unique(baselines, return_inverse=True)
+    t0 = times.min()
+    span = (times.max() - t0) + 1.
+    keys = rank * span + (times - t0)
+    order = np.argsort(keys, kind="mergesort")
+    return { 'baselines': unique_baselines, 't0': t0, 'span': span,
+             'keys': keys[order], 'times': times[order], 'uvw': uvws[order] }
+
+def uvw_reference_name(args):
+    # The name of the file we keep the real dataset's record coordinates in.
+    return "%s/uvw_reference_%s.npz" % (args['--temp-dir'],
+                                       os.path.basename(os.path.normpath(args['<dataset>'])))
+
+def make_uvw_reference(args):
+    # Make sure we have the record coordinates of the real dataset to check
+    # the segments against, reading them again only if the dataset has
+    # changed. Returns the name of the file they're in.
+    reference_name = uvw_reference_name(args)
+    cache_key = json.dumps(dataset_cache_key(args['<dataset>']))
+    if (os.path.isfile(reference_name)):
+        with np.load(reference_name) as reference:
+            if (str(reference['cache_key']) == cache_key):
+                return reference_name
+    print "  Reading the uvw coordinates of the real dataset"
+    reference = index_record_coordinates(*read_record_coordinates(args['<dataset>']))
+    with open(reference_name, "wb") as fp:
+        np.savez(fp, cache_key=np.array(cache_key), **reference)
+    return reference_name
+
+def load_uvw_reference(reference_name):
+    # Load the record coordinates of the real dataset, only once in each
+    # process unless make_uvw_reference has since written them again.
+    st = os.stat(reference_name)
+    file_key = (st.st_mtime, st.st_size)
+    if ((reference_name not in uvw_reference_cache) or
+        (uvw_reference_cache[reference_name]['key'] != file_key)):
+        with np.load(reference_name) as reference:
+            uvw_reference_cache[reference_name] = { 'key': file_key,
+                                                    'reference': dict([ (k, reference[k]) for k in reference.files ]) }
+    return uvw_reference_cache[reference_name]['reference']
+
+def compare_records(reference, times, baselines, uvws, tolerance, window):
+    # Match each record of a segment with the record of the real dataset on
+    # the same baseline that's nearest in time (within tolerance days), and
+    # work out how well they match. Every real record between the (start,
+    # end) times of the window (JD) should be matched.
+    result = { 'records': len(times), 'unmatched_model': 0, 'unmatched_real': 0,
+               'worst_time': 0., 'worst_uvw': 0. }
+    if (len(times) == 0):
+        result['unmatched_real'] = int(np.sum((reference['times'] >= window[0]) &
+                                              (reference['times'] <= window[1])))
+        return result
+    num_reference = len(reference['keys'])
+    rank = np.searchsorted(reference['baselines'], baselines)
+    known = ((rank < len(reference['baselines'])) &
+             (reference['baselines'][np.minimum(rank, len(reference['baselines']) - 1)] == baselines))
+    keys = rank * reference['span'] + (times - reference['t0'])
+    idx = np.searchsorted(reference['keys'], keys)
+    before = np.clip(idx - 1, 0, num_reference - 1)
+    after = np.clip(idx, 0, num_reference - 1)
+    nearest = np.where(np.abs(reference['keys'][before] - keys) <= np.abs(reference['keys'][after] - keys),
+                       before, after)
+    # Records on different baselines are always more than a day apart.
+    dt = np.abs(reference['keys'][nearest] - keys)
+    matched = known & (dt <= tolerance)
+    result['unmatched_model'] = int(np.sum(~matched))
+    if (np.any(matched)):
+        result['worst_time'] = float(np.max(dt[matched])) * 86400.
+        ruvw = reference['uvw'][nearest[matched]]
+        length = np.maximum(np.sqrt(np.sum(ruvw**2, axis=1)), 1e-6)
+        duvw = np.sqrt(np.sum((uvws[matched] - ruvw)**2, axis=1))
+        result['worst_uvw'] = float(np.max(duvw / length))
+    # Every real record in the time range of the segment needs a model record.
+    in_window = ((reference['times'] >= window[0]) & (reference['times'] <= window[1]))
+    covered = np.zeros(num_reference, dtype=bool)
+    covered[nearest[matched]] = True
+    result['unmatched_real'] = int(np.sum(in_window & ~covered))
+    return result
+
+def check_segment(segment_name, select, reference_name, cycle_time, uvw_tolerance):
+    # Check that a segment, cut out of the uvgen dataset with the uvaver
+    # selection select, matches the real dataset well enough for uvmodel,
+    # raising a ModelMismatchError if it doesn't. The times may differ by up
+    # to half a cycle (see the README for why).
+    (times, baselines, uvws) = read_record_coordinates(segment_name)
+    # The selection looks like time(start,end), in Miriad format.
+    window = [ float(mirtime_to_date(mt.upper())) + 2415020. for mt in select[5:-1].split(",") ]
+    result = compare_records(load_uvw_reference(reference_name), times, baselines, uvws,
+                             (cycle_time / 2.) / 86400., window)
+    if ((result['unmatched_model'] > 0) or (result['unmatched_real'] > 0) or
+        (result['worst_uvw'] > uvw_tolerance)):
+        raise ModelMismatchError("%s doesn't match the real dataset: %d of its %d records have no real record within half a cycle, %d real records have no model record, and the worst uvw difference is %.3g of the baseline length (%.3g is allowed)" % (segment_name, result['unmatched_model'], result['records'], result['unmatched_real'], result['worst_uvw'], uvw_tolerance))
+    return result
+
+def check_existing_segment(task, chop):
+    # Check a segment of a generation task that an earlier run made, or that
+    # came from the segment cache, if we're checking segments. Returns the
+    # result of the check, or None if we aren't checking.
+    if (task['uvw_reference'] is None):
+        return None
+    with profile_stage("check_uvw", segment=chop['number']):
+        return check_segment(chop['file'], chop['select'], task['uvw_reference'],
+                             task['cycle_time'], task['uvw_tolerance'])
+
+def worker_scratch_dir(stage_dir):
+    # The directory this process keeps its own scratch files in. Workers on
+    # different hosts can have the same process ID, so the host is part of it.
+    return "%s/worker_%s_%d" % (stage_dir, socket.gethostname(), os.getpid())
+
+def generate_segment(task):
+    # Run uvgen once, and then uvaver to cut out each segment that the task
+    # covers. The task is a dictionary prepared by add_source, and this routine
+    # may be run in a worker process when we are generating segments in parallel.
+    if task['separate_scratch']:
+        # Each worker gets its own directory so the simulated datasets and
+        # debugging files of different workers don't collide.
+        scratch_dir = worker_scratch_dir(task['temp_dir'])
+        if not os.path.isdir(scratch_dir):
+            os.makedirs(scratch_dir)
+        debug_dir = scratch_dir
+    else:
+        scratch_dir = None
+        debug_dir = "."
+    uvgen_pars = task['uvgen']
+    
+    # The name of the simulated dataset.
+    simulated_name = "%s/%s" % ((scratch_dir or task['temp_dir']), task['simulated_basename'])
+    # Delete this set if it exists.
+    if os.path.isdir(simulated_name):
+        shutil.rmtree(simulated_name)
+
+    # Run uvgen now.
+    print "  Running uvgen for source %d / %d" % ((task['number'] + 1), task['total'])
+    with open("%s/last_uvgen.dbg" % debug_dir, "w") as fp:
+        fp.write("uvgen source=%s ant=%s baseunit=%s telescop=%s corr=%s time=%s freq=%s radec=%s harange=%s stokes=%s lat=%s out=%s inttime=%s\n" % (uvgen_pars['source'], uvgen_pars['ant'], uvgen_pars['baseunit'], uvgen_pars['telescop'], uvgen_pars['corr'], uvgen_pars['time'], uvgen_pars['freq'], uvgen_pars['radec'], uvgen_pars['harange'], uvgen_pars['stokes'], uvgen_pars['lat'], simulated_name, uvgen_pars['inttime']))
+    run_miriad('uvgen', segment=task['chops'][0]['number'],
+               source=uvgen_pars['source'], ant=uvgen_pars['ant'],
+               baseunit=uvgen_pars['baseunit'], telescop=uvgen_pars['telescop'],
+               corr=uvgen_pars['corr'], time=uvgen_pars['time'],
+               freq=uvgen_pars['freq'], radec=uvgen_pars['radec'],
+               harange=uvgen_pars['harange'], stokes=uvgen_pars['stokes'],
+               lat=uvgen_pars['lat'], out=simulated_name,
+               inttime=uvgen_pars['inttime'])
+    # Chop out just the time ranges we want.
+    chop_files = []
+    checks = []
+    for i in xrange(0, len(task['chops'])):
+        chop_file = task['chops'][i]['file']
+        chop_time_select = task['chops'][i]['select']
+        if os.path.isdir(chop_file):
+            shutil.rmtree(chop_file)
+        #print "  Running uvaver to select time range %s" % chop_time_select
+        with open("%s/last_uvaver.dbg" % debug_dir, "w") as fp:
+            fp.write("uvaver vis=%s \"select=%s\" out=%s\n" % (simulated_name,
+                                                               chop_time_select,
+                                                               chop_file))
+        run_miriad('uvaver', segment=task['chops'][i]['number'],
+                   vis=simulated_name, select=chop_time_select, out=chop_file)
+        if (task['uvw_reference'] is not None):
+            with profile_stage("check_uvw", segment=task['chops'][i]['number']):
+                checks.append(check_segment(chop_file, chop_time_select, task['uvw_reference'],
+                                            task['cycle_time'], task['uvw_tolerance']))
+        record_completed(task['manifest'], chop_file, task['chops'][i]['hash'])
+        if (task['segment_cache'] is not None):
+            store_cached_segment(task['segment_cache'], task['chops'][i]['hash'], chop_file)
+        chop_files.append(chop_file)
+    # Nothing else needs the simulated dataset now.
+    simulated_size = dataset_size(simulated_name)
+    if task['cleanup']:
+        shutil.rmtree(simulated_name)
+    return (chop_files, simulated_size, checks, scratch_dir)
+
+def run_tasks(function, tasks, jobs):
+    # Run the function on each of the tasks, using a pool of processes if
+    # we've been asked for more than one job. The results are always returned
+    # in the same order as the tasks.
+    if ((jobs < 2) or (len(tasks) < 2)):
+        return [ function(task) for task in tasks ]
+    pool = multiprocessing.Pool(processes=min(jobs, len(tasks)))
+    try:
+        # Using map_async with a timeout allows Ctrl-C to interrupt the pool.
+        results = pool.map_async(function, tasks, chunksize=1).get(sys.maxint)
+    except:
+        # Stop straight away, rather than waiting for the rest of the tasks.
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+def task_hours(task):
+    # How long uvgen simulates for a generation task, in hours, including
+    # the integration at each end.
+    harange = [ float(h) for h in task['uvgen']['harange'].split(",") ]
+    return (harange[1] - harange[0]) + float(task['uvgen']['inttime']) / 3600.
+
+def generate_within_scratch(tasks, jobs, used_bytes, max_bytes):
+    # Run the generation tasks in waves of up to jobs tasks, only starting as
+    # many at once as we expect to fit in the scratch space that's left. The
+    # space a task needs is estimated from the size of the datasets uvgen has
+    # made so far. Returns the scratch space used once all the tasks are
+    # done, and the results of the tasks.
+    simulated_bytes = 0.
+    simulated_hours = 0.
+    results = []
+    t = 0
+    while (t < len(tasks)):
+        wave = [ tasks[t] ]
+        if (simulated_hours > 0):
+            # Each task needs space for the uvgen dataset and the segments
+            # cut from it, which can be as large as the uvgen dataset.
+            bytes_per_hour = 2. * simulated_bytes / simulated_hours
+            needed = bytes_per_hour * task_hours(tasks[t])
+            if ((used_bytes + needed) > max_bytes):
+                print "The scratch space limit of %.1f MB is too small: %.1f MB is in use, and the next segment needs about %.1f MB." % ((max_bytes / 1048576.), (used_bytes / 1048576.), (needed / 1048576.))
+                sys.exit()
+            while (((t + len(wave)) < len(tasks)) and (len(wave) < jobs)):
+                needed += bytes_per_hour * task_hours(tasks[t + len(wave)])
+                if ((used_bytes + needed) > max_bytes):
+                    break
+                wave.append(tasks[t + len(wave)])
+        wave_results = run_tasks(generate_segment, wave, jobs)
+        for w in xrange(0, len(wave)):
+            (chop_files, simulated_size, checks, scratch_dir) = wave_results[w]
+            used_bytes += sum([ dataset_size(cf) for cf in chop_files ])
+            if (not wave[w]['cleanup']):
+                used_bytes += simulated_size
+            simulated_bytes += simulated_size
+            simulated_hours += task_hours(wave[w])
+        results.extend(wave_results)
+        t += len(wave)
+    return (used_bytes, results)
+
+def staging_dir(args, work_dir):
+    # Where the intermediate datasets for the files in work_dir go. Unless the
+    # user has given a staging directory, that's work_dir itself.
+    if (args['--stage-dir'] is None):
+        return work_dir
+    if (os.path.abspath(work_dir) == os.path.abspath(args['--temp-dir'])):
+        return args['--stage-dir']
+    return "%s/%s" % (args['--stage-dir'], os.path.basename(os.path.normpath(work_dir)))
+
+def manifest_name(work_dir):
+    # The name of the file that records the products of a run.
+    return "%s/manifest.jsonl" % work_dir
+
+def read_manifest(name):
+    # Find the hash of the inputs of each completed product, keyed by the
+    # name of the product. Later records replace earlier ones.
+    completed = {}
+    if (not os.path.isfile(name)):
+        return completed
+    with open(name, "r") as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A record that was only partly written when the run was
+                # interrupted is simply ignored.
+                continue
+            completed[record['file']] = record['hash']
+    return completed
+
+def record_completed(name, product, input_hash):
+    # Add a record of a completed product to the manifest. Like the profile
+    # trace, each record is a single short write, so parallel workers can
+    # share the file.
+    with open(name, "a") as fp:
+        fp.write("%s\n" % json.dumps({ 'file': product, 'hash': input_hash }))
+
+def file_contents_hash(filename, file_hashes):
+    # The hash of the contents of a file, remembered in file_hashes so we only
+    # read each file once.
+    if (filename not in file_hashes):
+        with open(filename, "rb") as fp:
+            file_hashes[filename] = hashlib.sha1(fp.read()).hexdigest()
+    return file_hashes[filename]
+
+def segment_input_hash(uvgen_pars, select, file_hashes):
+    # A hash of everything that determines what a segment contains: the uvgen
+    # parameters, the contents of the source and antenna files they refer
+    # to, and the time range uvaver cuts out. The names of the files don't
+    # matter, so the same segment made for a different output or in a
+    # different directory has the same hash.
+    pars = dict(uvgen_pars)
+    pars['source'] = file_contents_hash(uvgen_pars['source'], file_hashes)
+    pars['ant'] = file_contents_hash(uvgen_pars['ant'], file_hashes)
+    inputs = { 'uvgen': pars, 'select': select }
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+def segment_cache_name(cache_dir, input_hash):
+    # The name of a segment in the cache.
+    return "%s/%s.uvgen" % (cache_dir, input_hash)
+
+def fetch_cached_segment(cache_dir, input_hash, chop_file):
+    # Copy a segment from the cache to chop_file if it's there, and mark it
+    # as recently used. Returns True if it was found.
+    cached_name = segment_cache_name(cache_dir, input_hash)
+    if (not os.path.isdir(cached_name)):
+        return False
+    if (os.path.isdir(chop_file)):
+        shutil.rmtree(chop_file)
+    try:
+        shutil.copytree(cached_name, chop_file)
+        os.utime(cached_name, None)
+    except (OSError, shutil.Error):
+        # Another run may have removed it from the cache while we were copying.
+        if (os.path.isdir(chop_file)):
+            shutil.rmtree(chop_file)
+        return False
+    return True
+
+def store_cached_segment(cache_dir, input_hash, chop_file):
+    # Put a copy of a newly made segment into the cache. It's copied under a
+    # temporary name and then renamed, so no other run can see it half copied.
+    cached_name = segment_cache_name(cache_dir, input_hash)
+    if (os.path.isdir(cached_name)):
+        os.utime(cached_name, None)
+        return
+    partial_name = "%s.%d.partial" % (cached_name, os.getpid())
+    shutil.copytree(chop_file, partial_name)
+    try:
+        os.rename(partial_name, cached_name)
+    except OSError:
+        # Another run put the same segment in the cache first.
+        shutil.rmtree(partial_name)
+
+def prune_segment_cache(cache_dir, max_mb):
+    # Remove the least recently used segments from the cache until it uses
+    # no more than max_mb of disk space. Returns how many were removed.
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if (not name.endswith(".uvgen")):
+            continue
+        cached_name = "%s/%s" % (cache_dir, name)
+        try:
+            size = dataset_size(cached_name)
+            entries.append((os.path.getmtime(cached_name), size, cached_name))
+        except OSError:
+            # It was removed by another run while we were looking.
+            continue
+        total += size
+    entries.sort()
+    num_removed = 0
+    for (last_used, size, cached_name) in entries:
+        if (total <= (max_mb * 1048576.)):
+            break
+        shutil.rmtree(cached_name, ignore_errors=True)
+        total -= size
+        num_removed += 1
+    return num_removed
+
+def dataset_cache_key(dataset_name):
+    # Describe the state of the dataset by the size and modification time of
+    # the files that hold its data. If any of these change, so does the key.
+    key = [ METADATA_CACHE_VERSION, os.path.abspath(dataset_name) ]
+    for item in [ "header", "vartable", "visdata", "flags" ]:
+        item_name = "%s/%s" % (dataset_name, item)
+        if (os.path.isfile(item_name)):
+            st = os.stat(item_name)
+            key.append((item, st.st_size, st.st_mtime))
+    return key
+
+def metadata_cache_name(dataset_name, cache_dir):
+    # The name of the file we cache the dataset metadata in.
+    return "%s/metadata_%s.cache" % (cache_dir,
+                                     os.path.basename(os.path.normpath(dataset_name)))
+
+def get_dataset_metadata(dataset_name, cache_dir=None):
+    # Find out what we need to know about the dataset: what was observed and
+    # when, the cycle time, and where the antennas were. If we're given a
+    # cache directory, we first look there for the results of an earlier run
+    # on the same, unchanged, dataset.
+    if (cache_dir is not None):
+        cache_name = metadata_cache_name(dataset_name, cache_dir)
+        cache_key = dataset_cache_key(dataset_name)
+        if (os.path.isfile(cache_name)):
+            try:
+                with open(cache_name, "rb") as fp:
+                    cached = pickle.load(fp)
+                if (cached['key'] == cache_key):
+                    print "     Using cached metadata from %s" % cache_name
+                    return cached['metadata']
+            except Exception:
+                # A damaged cache is simply ignored, and then overwritten.
+                pass
+        metadata = get_dataset_metadata(dataset_name)
+        with open(cache_name, "wb") as fp:
+            pickle.dump({ 'key': cache_key, 'metadata': metadata }, fp,
+                        pickle.HIGHEST_PROTOCOL)
+        return metadata
+
+    # Let's create a uvindex of the dataset first. The output can be very
+    # large, so it goes to a log that we then read one line at a time.
+    uvindex_log_name = "uvindex.log"
+    if (os.path.isfile(uvindex_log_name)):
+        os.remove(uvindex_log_name)
+    run_miriad('uvindex', vis=dataset_name, interval="0.1", log=uvindex_log_name)
+    with profile_stage("parse_uvindex"):
+        with open(uvindex_log_name, "r") as fp:
+            index_data = parse_uvindex(fp)
 
     # Get the cycle time.
     uvlist_log_name = "uvlist.log"
@@ -289,33 +1270,63 @@ def add_source(args):
         os.remove(uvlist_log_name)
     # We write to a log because otherwise this command waits for the user to press
     # the enter key halfway through operation.
-    miriad.uvlist(vis=dataset_name, options="variables,full",
-                  log=uvlist_log_name)
+    run_miriad('uvlist', vis=dataset_name, options="variables,full",
+               log=uvlist_log_name)
     telescope_variables = filter_uvlist_variables(uvlist_log_name)
     cycle_time = round(telescope_variables['cycle_time'])
     print "     Found cycle time of %d seconds" % cycle_time
     
     # Get the position of the telescope.
     miriad.set_filter('uvlist', filter_uvlist_antennas)
-    telescope_coordinates = miriad.uvlist(vis=dataset_name, options="array,full")
-    
+    telescope_coordinates = run_miriad('uvlist', vis=dataset_name, options="array,full")
+
+    return { 'index': index_data, 'cycle_time': cycle_time,
+             'telescope_coordinates': telescope_coordinates }
+
+def metadata_cache_dir(args):
+    # Where the user wants the dataset metadata cached, if anywhere.
+    if (args['--no-cache']):
+        return None
+    return args['--temp-dir']
+
+def make_telescope(telescope_coordinates):
     # Set up a pyephem observatory for this telescope.
     telescope = ephem.Observer()
     telescope.pressure = 0
     telescope.horizon = '12'
     telescope.lat = telescope_coordinates['latitude']
     telescope.lon = telescope_coordinates['longitude']
+    return telescope
 
-    # We generate a dataset for each source that we found.
-    # In general, if there is more than one source in the dataset, it's probably
-    # a mosaic.
+def uvgen_correlator(freq_config):
+    # Work out the uvgen corr and freq parameters that make the same spectral
+    # windows as a frequency configuration, one for each IF. The first IF
+    # sets the local oscillator frequency, and every window is offset from it.
+    # uvgen gives each window the same number of channels.
+    nchannels = freq_config['nchannels']
+    if (len(set(nchannels)) > 1):
+        print "ERROR: the IFs of frequency configuration %d have different numbers of channels (%s)" % (freq_config['number'],
+                                                                                                    ",".join([ str(n) for n in nchannels ]))
+        print "       uvgen can't make this configuration; split it out with uvaver first."
+        sys.exit()
+    windows = []
+    for i in xrange(0, len(nchannels)):
+        chan_offset = math.floor(nchannels[i] / 2)
+        chan_spacing_mhz = freq_config['frequency_increment'][i] * 1000.
+        freq_offset_mhz = ((freq_config['frequency1'][i] - freq_config['frequency1'][0]) * 1000. +
+                           chan_spacing_mhz * chan_offset)
+        width_mhz = chan_spacing_mhz * nchannels[i]
+        windows.append("%.3f,%.3f" % (freq_offset_mhz, width_mhz))
+    uvgen_corr = "%d,%d,%s" % (nchannels[0], len(nchannels), ",".join(windows))
+    uvgen_freq = "%.3f,0.0" % freq_config['frequency1'][0]
+    return (uvgen_corr, uvgen_freq)
 
-    # First, print a warning if the user has specified a source file (which only
-    # supports offsets) if there is more than one source.
-    if ((len(index_data['sources']) > 1) and (arguments['--source-file'] is not None)):
-        print "WARNING: multiple sources present, but a source file has been given."
-        print "         This is probably not what you wanted, but we continue in case it is."
-    
+def plan_generation(args, metadata, telescope):
+    # Work out everything needed to generate the model for each segment
+    # that doesn't depend on the sources being added.
+    index_data = metadata['index']
+    cycle_time = metadata['cycle_time']
+    telescope_coordinates = metadata['telescope_coordinates']
 
     # We'll go through in segments, as this will handle mosaic observations
     # more efficiently.
@@ -326,163 +1337,350 @@ def add_source(args):
     if (args['--test']):
         num_gens = 1
 
-    # The string to keep as input for the uvcat-ing.
-    uvcatString = ""
-    for i in xrange(0, num_gens):
-        # Make a source object for this position.
-        source = ephem.FixedBody()
-        source.name = segments[i]['source']
-        source._epoch = "2000"
-        source_index = -1
-        for j in xrange(0, len(index_data['sources'])):
-            if (index_data['sources'][j]['name'] == segments[i]['source']):
-                source._ra = index_data['sources'][j]['right_ascension']
-                source._dec = index_data['sources'][j]['declination']
-                source_index = j
-                break
-        source.compute()
-        sourceRa = 15. * stringToFloat(index_data['sources'][j]['right_ascension'])
-        sourceDec = stringToFloat(index_data['sources'][j]['declination'])
-        
+    # The antenna locations file is the same for every segment, so we
+    # write it only once.
+    uvgen_ant = "%s/antenna_configuration.file" % args['--temp-dir']
+    output_antenna_file(telescope_coordinates, uvgen_ant)
+
+    # Work out which segments are generated together. Normally each segment
+    # gets its own call to uvgen, but we can instead call uvgen only once for
+    # each pointing and frequency configuration, and cut every visit to that
+    # pointing with that configuration from its output. uvgen simulates all
+    # the time between the visits too, so a pointing that isn't visited for
+    # a long time gets a new call.
+    generation_groups = []
+    if (args['--per-pointing']):
+        max_gap = float(args['--pointing-gap']) / 1440. # in days
+        pointing_groups = {}
+        for i in xrange(0, num_gens):
+            group_key = (segments[i]['source'], segments[i]['freq_config'])
+            if ((group_key not in pointing_groups) or
+                ((segments[i]['start_time'] - segments[pointing_groups[group_key][-1]]['end_time']) > max_gap)):
+                pointing_groups[group_key] = []
+                generation_groups.append(pointing_groups[group_key])
+            pointing_groups[group_key].append(i)
+    else:
+        for i in xrange(0, num_gens):
+            generation_groups.append([ i ])
+    num_groups = len(generation_groups)
+
+    # Work out when each group starts and ends, and where its pointing is.
+    # The group covers the time from the start of its first segment to the
+    # end of its last segment.
+    pointings = dict([ (src['name'], src) for src in index_data['sources'] ])
+    group_pointing = [ segments[group[0]]['source'] for group in generation_groups ]
+    group_config = [ segments[group[0]]['freq_config'] for group in generation_groups ]
+    group_start_time = np.array([ segments[group[0]]['start_time'] for group in generation_groups ])
+    group_end_time = np.array([ segments[group[-1]]['end_time'] for group in generation_groups ])
+    pointing_ra = np.array([ stringToFloat(pointings[name]['right_ascension'])
+                             for name in group_pointing ]) # in hours
+    pointing_dec = np.array([ stringToFloat(pointings[name]['declination'])
+                              for name in group_pointing ]) # in degrees
+
+    ##### Find the hour angles at which each pointing was observed.
+    start_hour_angle = hour_angles(telescope, pointing_ra, group_start_time)
+    finish_hour_angle = hour_angles(telescope, pointing_ra, group_end_time)
+    # Long time ranges can wrap around from +12 to -12 hours.
+    finish_hour_angle[finish_hour_angle < start_hour_angle] += 24.
+
+    # Work out the 0 hour angle. Get the nearest time to 0.
+    transit_time = np.where(np.abs(start_hour_angle) < np.abs(finish_hour_angle),
+                            group_start_time - (start_hour_angle * ephem.hour),
+                            group_end_time - (finish_hour_angle * ephem.hour))
+
+    if (args['--exact-times']):
+        # uvgen only gets the transit time to the nearest second, so we
+        # work out the hour angles from that.
+        start_ha = np.zeros(num_groups)
+        finish_ha = np.zeros(num_groups)
+        for g in xrange(0, num_groups):
+            transit_time[g] = truncate_date_second(ephem.Date(transit_time[g]))
+            (start_ha[g], finish_ha[g]) = cycle_hour_angle_range(group_start_time[g], group_end_time[g],
+                                                                 transit_time[g], cycle_time)
+    else:
+        # Extend the HA range a little on each side.
+        sidereal_modifier = 1.00273790935
+        start_ha = np.floor(start_hour_angle * 10. * sidereal_modifier) / 10. - 0.05
+        finish_ha = np.ceil(finish_hour_angle * 10. * sidereal_modifier) / 10. + 0.05
+
+    # These uvgen parameters are the same for every group.
+    uvgen_telescop = telescope_coordinates['telescope'].lower()
+    uvgen_stokes = ",".join(index_data['polarisations']).lower()
+    uvgen_lat = "%.6f" % math.degrees(telescope.lat)
+    # Each frequency configuration has its own correlator setup, with all
+    # its IFs generated together.
+    correlators = {}
+    for freq_config in index_data['freq_configs']:
+        correlators[freq_config['number']] = uvgen_correlator(freq_config)
+    for config in set(group_config):
+        if (config not in correlators):
+            print "ERROR: frequency configuration %d is used but wasn't described by uvindex" % config
+            sys.exit()
+    uvgen_baseunit = 3.33564
+
+    # Now make the inputs to uvgen for each group.
+    groups = []
+    for g in xrange(0, num_groups):
+        uvgen_radec = "%s,%s" % (pointings[group_pointing[g]]['right_ascension'],
+                                 pointings[group_pointing[g]]['declination'])
+        if (args['--exact-times']):
+            uvgen_harange = "%.6f,%.6f" % (start_ha[g], finish_ha[g])
+        else:
+            uvgen_harange = "%.2f,%.2f" % (start_ha[g], finish_ha[g])
+        # The time at 0 HA.
+        uvgen_time = date_to_mirtime(ephem.Date(transit_time[g]))
+        (uvgen_corr, uvgen_freq) = correlators[group_config[g]]
         
-        ##### Find the times that this source was observed.
-        # Where was the source at the start of the observations?
-        # Go to the starting time of the observation.
-        telescope.date = ephem.Date(segments[i]['start_time'])
-        # We really just need the hour angle.
-        start_hour_angle = get_hour_angle(source, telescope)
-
-        # And the same for the end of the observation.
-        telescope.date = ephem.Date(segments[i]['end_time'])
-        finish_hour_angle = get_hour_angle(source, telescope)
-        #print "%s %f %f" % (source.name, start_hour_angle, finish_hour_angle)
-
-        # Work out the 0 hour angle. Get the nearest time to 0.
-        transit_time = None
-        if (abs(start_hour_angle) < abs(finish_hour_angle)):
-            transit_time = segments[i]['start_time'] - (start_hour_angle * ephem.hour)
+        # Work out the time ranges we want to chop out.
+        chops = []
+        for i in generation_groups[g]:
+            chop_start_time = date_to_mirtime(ephem.Date(segments[i]['start_time'] - (cycle_time / 2) * ephem.second))
+            chop_end_time = date_to_mirtime(ephem.Date(segments[i]['end_time'] + (cycle_time / 2) * ephem.second))
+            chops.append({ 'number': i,
+                           'select': "time(%s,%s)" % (chop_start_time, chop_end_time) })
+
+        groups.append({
+            'number': g, 'pointing': group_pointing[g], 'freq_config': group_config[g],
+            'pointing_ra': 15. * pointing_ra[g], 'pointing_dec': pointing_dec[g],
+            'uvgen': { 'ant': uvgen_ant,
+                       'baseunit': uvgen_baseunit, 'telescop': uvgen_telescop,
+                       'corr': uvgen_corr, 'time': uvgen_time, 'freq': uvgen_freq,
+                       'radec': uvgen_radec, 'harange': uvgen_harange,
+                       'stokes': uvgen_stokes, 'lat': uvgen_lat,
+                       'inttime': cycle_time },
+            'chops': chops })
+
+    # The whole plan can be looked at as a single table.
+    # How much time each group simulates, and how much of it was observed,
+    # in hours; each segment includes the whole of its first and last cycles.
+    observed_hours = np.array([ sum([ (segments[i]['end_time'] - segments[i]['start_time']) * 24. +
+                                      cycle_time / 3600. for i in group ])
+                                for group in generation_groups ])
+    simulated_hours = (finish_ha - start_ha) / 1.00273790935
+    table = { 'pointing': np.array(group_pointing), 'freq_config': np.array(group_config),
+              'observed_hours': observed_hours, 'simulated_hours': simulated_hours,
+              'num_segments': np.array([ len(group) for group in generation_groups ]),
+              'start_time': group_start_time, 'end_time': group_end_time,
+              'start_hour_angle': start_hour_angle, 'finish_hour_angle': finish_hour_angle,
+              'transit_time': transit_time, 'start_ha': start_ha, 'finish_ha': finish_ha }
+
+    return { 'num_segments': num_gens, 'cycle_time': cycle_time, 'groups': groups, 'table': table }
+
+def print_plan(plan):
+    # Print the generation plan as a table, and how much time it simulates.
+    table = plan['table']
+    print "%5s %-12s %6s %5s %-20s %-20s %9s %9s %-20s %-21s %7s %7s" % ("Group", "Pointing", "Config", "Nseg",
+                                                                         "Start", "End", "Start HA", "End HA",
+                                                                         "Transit", "uvgen harange",
+                                                                         "Sim h", "Obs h")
+    for g in xrange(0, len(plan['groups'])):
+        print "%5d %-12s %6d %5d %-20s %-20s %9.5f %9.5f %-20s %-21s %7.3f %7.3f" % (g, table['pointing'][g], table['freq_config'][g],
+                                                                                   table['num_segments'][g],
+                                                                                   ephem.Date(table['start_time'][g]),
+                                                                                   ephem.Date(table['end_time'][g]),
+                                                                                   table['start_hour_angle'][g],
+                                                                                   table['finish_hour_angle'][g],
+                                                                                   ephem.Date(table['transit_time'][g]),
+                                                                                   plan['groups'][g]['uvgen']['harange'],
+                                                                                   table['simulated_hours'][g],
+                                                                                   table['observed_hours'][g])
+    print "%d uvgen calls simulate %.2f hours, to make %.2f hours of observed segments" % (len(plan['groups']),
+                                                                                         table['simulated_hours'].sum(),
+                                                                                         table['observed_hours'].sum())
+
+def generate_segments(args, group_tasks, completed, num_segments):
+    # Make the segments for the generation tasks, except those an earlier run
+    # has already made, or that we can copy from the segment cache.
+    num_jobs = int(args['--jobs'])
+    segment_cache = args['--segment-cache']
+    segment_tasks = []
+    num_reused = 0
+    num_cached = 0
+    used_bytes = 0
+    checks = []
+    try:
+        for task in group_tasks:
+            chops = []
+            for chop in task['chops']:
+                # We don't need to make a segment again if its inputs haven't changed.
+                if ((completed.get(chop['file']) == chop['hash']) and os.path.isdir(chop['file'])):
+                    num_reused += 1
+                elif ((segment_cache is not None) and
+                      fetch_cached_segment(segment_cache, chop['hash'], chop['file'])):
+                    record_completed(task['manifest'], chop['file'], chop['hash'])
+                    num_cached += 1
+                else:
+                    chops.append(chop)
+                    continue
+                # A segment we didn't make this time gets the same check as one we did.
+                check = check_existing_segment(task, chop)
+                if (check is not None):
+                    checks.append(check)
+                if (args['--max-scratch'] is not None):
+                    used_bytes += dataset_size(chop['file'])
+            if (len(chops) > 0):
+                task['chops'] = chops
+                segment_tasks.append(task)
+    except ModelMismatchError as e:
+        print "ERROR: %s" % e
+        sys.exit()
+
+    # Generate all the segments we don't already have.
+    if (num_reused > 0):
+        print "  Reusing %d segments from an earlier run" % num_reused
+    if (num_cached > 0):
+        print "  Copied %d segments from the segment cache" % num_cached
+    if (num_jobs > 1):
+        print "  Generating %d segments using %d processes" % ((num_segments - num_reused - num_cached),
+                                                               num_jobs)
+    try:
+        if (args['--max-scratch'] is None):
+            results = run_tasks(generate_segment, segment_tasks, num_jobs)
         else:
-            transit_time = segments[i]['end_time'] - (finish_hour_angle * ephem.hour)
-        transit_time = ephem.Date(transit_time)
+            (used_bytes, results) = generate_within_scratch(segment_tasks, num_jobs, used_bytes,
+                                                            float(args['--max-scratch']) * 1048576.)
+            print "  The segments use %.1f MB of scratch space" % (used_bytes / 1048576.)
+    except ModelMismatchError as e:
+        print "ERROR: %s" % e
+        sys.exit()
+    checks += [ check for (chop_files, simulated_size, task_checks, scratch_dir) in results
+                for check in task_checks ]
+    if (len(checks) > 0):
+        print "  The uvw check passed for %d segments: the worst time difference was %.2f s, and the worst uvw difference was %.3g of the baseline length" % (len(checks), max([ c['worst_time'] for c in checks ]), max([ c['worst_uvw'] for c in checks ]))
+    if ((len(segment_tasks) > 0) and segment_tasks[0]['separate_scratch'] and
+        segment_tasks[0]['cleanup']):
+        # Our workers' directories only have debugging files left in them.
+        for scratch_dir in set([ result[3] for result in results ]):
+            if ((scratch_dir is not None) and os.path.isdir(scratch_dir)):
+                shutil.rmtree(scratch_dir)
+    if (segment_cache is not None):
+        num_removed = prune_segment_cache(segment_cache, float(args['--cache-size']))
+        if (num_removed > 0):
+            print "  Removed %d least recently used segments from the segment cache" % num_removed
 
-        #print "transit time is %s" % transit_time
+def prepare_sources(args, sources):
+    # Work out what we need to make the uvgen source files for the sources:
+    # their positions, the spatial index if we only want the sources near
+    # each pointing, and the source files already made for each pointing
+    # position. This can be shared between datasets with pointings in common.
+    shared = { 'sources': sources, 'positions': None, 'index': None, 'files': {} }
+    if (sources is not None):
+        shared['positions'] = source_positions(sources)
+        if (args['--source-radius'] is not None):
+            shared['index'] = index_sources(shared['positions'], float(args['--source-radius']) / 60.)
+    return shared
 
+def make_generation_tasks(args, plan, sources, out_name, work_dir, stage_dir, manifest, shared=None):
+    # Make the generation tasks for a set of sources using a plan from
+    # plan_generation; only the source differs from the plan. Returns the
+    # tasks, and the number, file name and input hash of each segment, in the
+    # order they were observed. If sources is None, we use the user's source
+    # file instead. Source files already in shared, from prepare_sources, are
+    # used again for pointings at the same position.
+    if (shared is None):
+        shared = prepare_sources(args, sources)
+    groups = plan['groups']
+    num_groups = len(groups)
+    file_hashes = {}
+    group_tasks = []
+    chop_numbers = []
+    num_near = []
+    uvw_reference = None
+    if args['--check-uvw']:
+        uvw_reference = make_uvw_reference(args)
+    for g in xrange(0, num_groups):
+        group = groups[g]
+        position = (group['pointing_ra'], group['pointing_dec'])
         # Work out the inputs to uvgen.
-        if (arguments['--source-file'] is not None):
-            uvgen_source = arguments['--source-file']
+        if (sources is None):
+            uvgen_source = args['--source-file']
+        elif (position in shared['files']):
+            # We've already made the file for this pointing.
+            uvgen_source = shared['files'][position]
         else:
             # We create the source file per pointing.
             # Determine the offset between the sources we want to add and the pointing centre.
-            src_lines = []
-            for j in xrange(0, len(args['--ra'])):
-                nsource = ephem.FixedBody()
-                nsource._epoch = "2000"
-                nsource._ra = args['--ra'][j]
-                nsource._dec = args['--dec'][j]
-                nsource.compute()
-                nsourceRa = 15. * stringToFloat(args['--ra'][j])
-                nsourceDec = stringToFloat(args['--dec'][j])
-                #dra = (nsource.ra - source.ra) * (180. * 3600.) / math.pi # in arcseconds
-                #ddec = (nsource.dec - source.dec) * (180. * 3600.) / math.pi # also in arcseconds
-                avdec = ((nsourceDec + sourceDec) / 2.) * (math.pi / 180.)
-                dra = (nsourceRa - sourceRa) * 3600. * math.cos(avdec)
-                ddec = (nsourceDec - sourceDec) * 3600.
-                # The source flux density.
-                fluxdens = float(args['--flux'][j]) # in Jy
-                # The source size.
-                szel = args['--size'][j].split(",")
-                if (len(szel) != 3):
-                    print "ERROR: the size of source %d was not correctly specified" % (j + 1)
-                    sys.exit()
-                bmaj = float(szel[0])
-                bmin = float(szel[1])
-                bpa = float(szel[2])
-                # The spectral index.
-                specidx = float(args['--alpha'][j])
-                src_lines.append("%.6f,%.3f,%.3f,%.3f,%.3f,%.3f,0,0,0,%.3f" % (fluxdens, dra, ddec,
-                                                                               bmaj, bmin, bpa, specidx))
+            selected = None
+            if (shared['index'] is not None):
+                selected = sources_near(shared['index'], group['pointing_ra'], group['pointing_dec'])
+                num_near.append(len(selected))
+            src_lines = source_file_lines(sources, shared['positions'], group['pointing_ra'],
+                                          group['pointing_dec'], selected)
             # Make the file.
-            uvgen_source = "%s/source_created_%s" % (args['--temp-dir'],
-                                                     source.name)
+            uvgen_source = "%s/source_created_%s" % (work_dir, group['pointing'])
             #print "  Creating source generation file %s" % uvgen_source
             with open(uvgen_source, "w") as fp:
                 for j in xrange(0, len(src_lines)):
                     fp.write("%s\n" % src_lines[j])
-            
-        uvgen_telescop = telescope_coordinates['telescope'].lower()
-        uvgen_stokes = ",".join(index_data['polarisations']).lower()
-        #print uvgen_source
-        #print uvgen_telescop
-        #print uvgen_stokes
-        uvgen_lat = "%.6f" % math.degrees(telescope.lat)
-        #print uvgen_lat
-        uvgen_radec = "%s,%s" % (index_data['sources'][source_index]['right_ascension'],
-                                 index_data['sources'][source_index]['declination'])
-        #print uvgen_radec
-        # Extend the HA range a little on each side.
-        sidereal_modifier = 1.00273790935
-        start_ha = math.floor(start_hour_angle * 10. * sidereal_modifier) / 10. - 0.05
-        finish_ha = math.ceil(finish_hour_angle * 10. * sidereal_modifier) / 10. + 0.05
-        uvgen_harange = "%.2f,%.2f" % (start_ha, finish_ha)
-        #print uvgen_harange
-        # The time at 0 HA.
-        uvgen_time = date_to_mirtime(transit_time)
-        #print uvgen_time
-        # Use only frequency config 0, but we could probably change that if we need to.
-        #print index_data['freq_configs']
-        chan_offset = math.floor(index_data['freq_configs'][0]['nchannels'][0] / 2)
-        chan_spacing_mhz = index_data['freq_configs'][0]['frequency_increment'][0] * 1000.
-        freq_offset_mhz = chan_spacing_mhz * chan_offset
-        width_mhz = chan_spacing_mhz * index_data['freq_configs'][0]['nchannels'][0]
-        uvgen_corr = "%d,1,%d,%.3f" % (index_data['freq_configs'][0]['nchannels'][0],
-                                       freq_offset_mhz, width_mhz)
-        #print uvgen_corr
-        uvgen_freq = "%.3f,0.0" % index_data['freq_configs'][0]['frequency1'][0]
-        #print uvgen_freq
-        # Now we have to write out the antenna locations file.
-        uvgen_ant = "antenna_configuration.file"
-        output_antenna_file(telescope_coordinates, uvgen_ant)
-        uvgen_baseunit = 3.33564
-        
-        # The name of the simulated dataset.
-        simulated_name = "%s/%s_%s.uvgen" % (args['--temp-dir'], args['--out'],
-                                             source.name)
-        # Delete this set if it exists.
-        if os.path.isdir(simulated_name):
-            shutil.rmtree(simulated_name)
-
-        # Run uvgen now.
-        print "  Running uvgen for source %d / %d" % ((i + 1), num_gens)
-        with open("last_uvgen.dbg", "w") as fp:
-            fp.write("uvgen source=%s ant=%s baseunit=%s telescop=%s corr=%s time=%s freq=%s radec=%s harange=%s stokes=%s lat=%s out=%s inttime=%s\n" % (uvgen_source, uvgen_ant, uvgen_baseunit, uvgen_telescop, uvgen_corr, uvgen_time, uvgen_freq, uvgen_radec, uvgen_harange, uvgen_stokes, uvgen_lat, simulated_name, cycle_time))
-        miriad.uvgen(source=uvgen_source, ant=uvgen_ant, baseunit=uvgen_baseunit,
-                     telescop=uvgen_telescop, corr=uvgen_corr, time=uvgen_time,
-                     freq=uvgen_freq, radec=uvgen_radec, harange=uvgen_harange,
-                     stokes=uvgen_stokes, lat=uvgen_lat, out=simulated_name,
-                     inttime=cycle_time)
-        # Chop out just the time range we want.
-        chop_start_time = date_to_mirtime(ephem.Date(segments[i]['start_time'] - (cycle_time / 2) * ephem.second))
-        chop_end_time = date_to_mirtime(ephem.Date(segments[i]['end_time'] + (cycle_time / 2) * ephem.second))
-        chop_time_select = "time(%s,%s)" % (chop_start_time, chop_end_time)
-        chop_file = "%s/segment_%04d.uvgen" % (args['--temp-dir'], i)
-        if os.path.isdir(chop_file):
-            shutil.rmtree(chop_file)
-        #print "  Running uvaver to select time range %s - %s" % (chop_start_time, chop_end_time)
-        with open("last_uvaver.dbg", "w") as fp:
-            fp.write("uvaver vis=%s \"select=%s\" out=%s\n" % (simulated_name,
-                                                               chop_time_select,
-                                                               chop_file))
-        miriad.uvaver(vis=simulated_name, select=chop_time_select,
-                      out=chop_file)
-        # Add this dataset to the uvcat string.
-        uvcatString = add_uvcat(uvcatString, chop_file, args['--temp-dir'])
-
-    # Do the final uvcat.
-    finalout = "%s/allsegments.uvgen" % args['--temp-dir']
-    print "  Concatenating final product"
-    if os.path.isdir(finalout):
-        shutil.rmtree(finalout)
-    miriad.uvcat(vis=uvcatString, out=finalout)
+            shared['files'][position] = uvgen_source
+        uvgen_pars = dict(group['uvgen'])
+        uvgen_pars['source'] = uvgen_source
+        chops = []
+        for c in xrange(0, len(group['chops'])):
+            chop = { 'number': group['chops'][c]['number'],
+                     'select': group['chops'][c]['select'],
+                     'file': "%s/segment_%04d.uvgen" % (stage_dir, group['chops'][c]['number']) }
+            chop['hash'] = segment_input_hash(uvgen_pars, chop['select'], file_hashes)
+            chop_numbers.append((chop['number'], chop['file'], chop['hash']))
+            chops.append(chop)
+        group_tasks.append({
+            'number': g, 'total': num_groups, 'temp_dir': stage_dir,
+            'separate_scratch': (int(args['--jobs']) > 1), 'manifest': manifest,
+            'segment_cache': args['--segment-cache'], 'cleanup': (not args['--keep-intermediates']),
+            'uvw_reference': uvw_reference, 'cycle_time': plan['cycle_time'],
+            'uvw_tolerance': float(args['--uvw-tolerance']),
+            'simulated_basename': "%s_%s.uvgen" % (os.path.basename(out_name), group['pointing']),
+            'uvgen': uvgen_pars, 'chops': chops })
+    if (len(num_near) > 0):
+        print "  Each new pointing has between %d and %d of the %d sources within %s arcmin" % (min(num_near), max(num_near),
+                                                                                           len(sources),
+                                                                                           args['--source-radius'])
+    chop_numbers.sort()
+    return (group_tasks, chop_numbers)
+
+def concatenated_segments(chop_numbers, stage_dir):
+    # The name of the dataset the segments are concatenated into, and the
+    # hash of its inputs that we record in the manifest.
+    finalout = "%s/allsegments.uvgen" % stage_dir
+    finalout_hash = hashlib.sha1(json.dumps([ ch for (cn, cf, ch) in chop_numbers ])).hexdigest()
+    return (finalout, finalout_hash)
+
+def have_concatenated(chop_numbers, stage_dir, completed):
+    # Whether an earlier run got as far as concatenating the same segments,
+    # in which case we only need to redo the mixing. Either mixer can use
+    # the concatenated segments.
+    (finalout, finalout_hash) = concatenated_segments(chop_numbers, stage_dir)
+    return ((completed.get(finalout) == finalout_hash) and os.path.isdir(finalout))
+
+def mix_segments(args, chop_numbers, out_name, stage_dir, manifest, completed, cycle_time):
+    # Mix the segments into the real dataset as out_name, concatenating them
+    # first unless we're using the streaming mixer.
+    chop_files = [ cf for (cn, cf, ch) in chop_numbers ]
+    cleanup = not args['--keep-intermediates']
+    if (args['--mixer'] == "stream"):
+        # We read the segments directly, so they don't need concatenating,
+        # unless an earlier run has already concatenated them (and then
+        # probably deleted them).
+        model_files = chop_files
+        if have_concatenated(chop_numbers, stage_dir, completed):
+            model_files = [ concatenated_segments(chop_numbers, stage_dir)[0] ]
+        print "  Adding the model to the initial dataset."
+        with profile_stage("stream_mix", out=out_name):
+            stream_mix(args['<dataset>'], model_files, out_name, cycle_time,
+                       float(args['--mix-memory']))
+        if cleanup:
+            for model_file in model_files:
+                if os.path.isdir(model_file):
+                    shutil.rmtree(model_file)
+        print "Process complete. The mixed dataset can be found at %s" % out_name
+        return
+
+    # Concatenate the segments together, in the order they were observed.
+    (finalout, finalout_hash) = concatenated_segments(chop_numbers, stage_dir)
+    if (not have_concatenated(chop_numbers, stage_dir, completed)):
+        with profile_stage("concatenate", out=finalout):
+            concatenate_files(chop_files, finalout, stage_dir, int(args['--jobs']), cleanup)
+        record_completed(manifest, finalout, finalout_hash)
 
     # Mix in the two datasets.
     print "  Adding the model to the initial dataset."
@@ -490,23 +1688,462 @@ def add_source(args):
         print "Something has gone wrong and the fake dataset has not been generated."
         sys.exit()
 
-    miriad.uvmodel(vis=args['<dataset>'], model=finalout, select="-auto", options="add",
-                   out=args['--out'])
-    print "Process complete. The mixed dataset can be found at %s" % args['--out']
+    run_miriad('uvmodel', vis=args['<dataset>'], model=finalout, select="-auto", options="add",
+               out=out_name)
+    # The concatenated segments are kept until now so a failed mix can be retried.
+    if cleanup:
+        shutil.rmtree(finalout)
+    print "Process complete. The mixed dataset can be found at %s" % out_name
+
+def realise_sources(args, metadata, plan, sources, out_name, work_dir):
+    # Generate the model for a set of sources using a plan from
+    # plan_generation, and mix it into the real dataset as out_name. All the
+    # intermediate files go into work_dir, or the staging directory. If
+    # sources is None, we use the user's source file instead.
+    stage_dir = staging_dir(args, work_dir)
+    if (not os.path.isdir(stage_dir)):
+        os.makedirs(stage_dir)
+
+    # Find out which segments an earlier run has already made.
+    manifest = manifest_name(work_dir)
+    if (args['--fresh'] and os.path.isfile(manifest)):
+        os.remove(manifest)
+    completed = read_manifest(manifest)
+
+    (group_tasks, chop_numbers) = make_generation_tasks(args, plan, sources, out_name, work_dir,
+                                                        stage_dir, manifest)
+    if have_concatenated(chop_numbers, stage_dir, completed):
+        print "  Reusing the concatenated segments from an earlier run"
+    else:
+        generate_segments(args, group_tasks, completed, plan['num_segments'])
+    mix_segments(args, chop_numbers, out_name, stage_dir, manifest, completed,
+                 metadata['cycle_time'])
+
+def work_manifest_name(temp_dir):
+    # The name of the file that describes the work units of a sharded run.
+    return "%s/work_manifest.json" % temp_dir
+
+def work_unit_name(temp_dir, number):
+    # The name that the lock and done files of a work unit start with.
+    return "%s/work_units/unit_%05d" % (temp_dir, number)
+
+def write_work_manifest(args, metadata, plan, sources):
+    # Write each generation task as a work unit that any worker can claim,
+    # along with what the merge needs to know. The workers may run in other
+    # directories, so every path in the work manifest is absolute.
+    args = dict(args)
+    for option in [ '<dataset>', '--out', '--temp-dir', '--stage-dir', '--segment-cache',
+                    '--source-file', '--catalogue' ]:
+        if (args[option] is not None):
+            args[option] = os.path.abspath(args[option])
+    work_dir = args['--temp-dir']
+    stage_dir = staging_dir(args, work_dir)
+    units_dir = "%s/work_units" % work_dir
+    # The done and lock files from any earlier plan don't apply to this one.
+    if (os.path.isdir(units_dir)):
+        shutil.rmtree(units_dir)
+    os.makedirs(units_dir)
+    (group_tasks, chop_numbers) = make_generation_tasks(args, plan, sources, args['--out'], work_dir,
+                                                        stage_dir, None)
+    for u in xrange(0, len(group_tasks)):
+        task = group_tasks[u]
+        # Workers on different machines can't share a manifest file, so
+        # each unit records the segments it makes in its own.
+        task['manifest'] = "%s.segments" % work_unit_name(work_dir, u)
+        # Workers on different machines may have the same process ID, so the
+        # simulated dataset names have to be different for each unit.
+        task['separate_scratch'] = True
+        task['uvgen']['ant'] = os.path.abspath(task['uvgen']['ant'])
+        task['simulated_basename'] = "%s_%s_%05d.uvgen" % (os.path.basename(args['--out']),
+                                                           plan['groups'][task['number']]['pointing'], u)
+    work = { 'dataset': args['<dataset>'], 'out': args['--out'], 'stage_dir': stage_dir,
+             'cycle_time': metadata['cycle_time'], 'units': group_tasks,
+             'segments': chop_numbers }
+    with open(work_manifest_name(work_dir), "w") as fp:
+        json.dump(work, fp)
+    print "Wrote %d work units for %d segments to %s" % (len(group_tasks), len(chop_numbers),
+                                                         work_manifest_name(work_dir))
+
+def process_alive(pid):
+    # Whether a process with this ID is running on this machine.
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return (e.errno == errno.EPERM)
+    return True
+
+def claim_work_unit(unit_name):
+    # Try to claim a work unit by creating its lock file, which only one
+    # process can do. The lock says which machine and process claimed it.
+    try:
+        fd = os.open("%s.lock" % unit_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if (e.errno != errno.EEXIST):
+            raise
+        if (not break_stale_lock(unit_name)):
+            return False
+        return claim_work_unit(unit_name)
+    os.write(fd, "%s %d\n" % (socket.gethostname(), os.getpid()))
+    os.close(fd)
+    return True
+
+def break_stale_lock(unit_name):
+    # If a work unit was claimed by a process on this machine that has since
+    # died, remove its lock so the unit can be claimed again. Locks held by
+    # other machines have to be removed by hand. The lock is renamed away
+    # first, so only one process can break it.
+    lock_name = "%s.lock" % unit_name
+    try:
+        with open(lock_name, "r") as fp:
+            (host, pid) = fp.read().split()
+    except (IOError, ValueError):
+        # It's gone, or it's still being written.
+        return False
+    if ((host != socket.gethostname()) or process_alive(int(pid))):
+        return False
+    stale_name = "%s.stale_%d" % (lock_name, os.getpid())
+    try:
+        os.rename(lock_name, stale_name)
+    except OSError:
+        # Another process broke it first.
+        return False
+    os.remove(stale_name)
+    print "  Reclaiming work unit %s from process %s, which has stopped" % (os.path.basename(unit_name), pid)
+    return True
+
+def work_on_units(temp_dir):
+    # Claim work units, generate their segments and mark them as done, until
+    # there are none left to claim. Returns the number of units we did.
+    with open(work_manifest_name(temp_dir), "r") as fp:
+        work = json.load(fp)
+    num_done = 0
+    for u in xrange(0, len(work['units'])):
+        unit_name = work_unit_name(temp_dir, u)
+        if (os.path.isfile("%s.done" % unit_name) or (not claim_work_unit(unit_name))):
+            continue
+        task = work['units'][u]
+        # Only make the segments we can't find in the segment cache.
+        chops = []
+        for chop in task['chops']:
+            if ((task['segment_cache'] is None) or
+                (not fetch_cached_segment(task['segment_cache'], chop['hash'], chop['file']))):
+                chops.append(chop)
+            else:
+                check_existing_segment(task, chop)
+        if (len(chops) > 0):
+            task['chops'] = chops
+            generate_segment(task)
+        # The done file is renamed into place, so it's never seen half written.
+        with open("%s.done.partial" % unit_name, "w") as fp:
+            fp.write("%s %d\n" % (socket.gethostname(), os.getpid()))
+        os.rename("%s.done.partial" % unit_name, "%s.done" % unit_name)
+        num_done += 1
+    # Our own scratch directory only has debugging files left in it.
+    scratch_dir = worker_scratch_dir(work['stage_dir'])
+    if ((num_done > 0) and work['units'][0]['cleanup'] and os.path.isdir(scratch_dir)):
+        shutil.rmtree(scratch_dir)
+    return num_done
+
+def shard_worker(args):
+    # Be one of the workers of a sharded run, using --jobs processes.
+    temp_dir = args['--temp-dir']
+    if (not os.path.isfile(work_manifest_name(temp_dir))):
+        print "No work manifest found in %s; run with --shard plan first." % temp_dir
+        sys.exit()
+    num_jobs = int(args['--jobs'])
+    try:
+        num_done = sum(run_tasks(work_on_units, [ temp_dir ] * num_jobs, num_jobs))
+    except ModelMismatchError as e:
+        print "ERROR: %s" % e
+        sys.exit()
+    print "This worker generated %d work units." % num_done
+
+def shard_merge(args):
+    # Mix the segments generated by the workers of a sharded run into the
+    # real dataset, once all the work units are done.
+    temp_dir = args['--temp-dir']
+    if (not os.path.isfile(work_manifest_name(temp_dir))):
+        print "No work manifest found in %s; run with --shard plan first." % temp_dir
+        sys.exit()
+    with open(work_manifest_name(temp_dir), "r") as fp:
+        work = json.load(fp)
+    missing = [ u for u in xrange(0, len(work['units']))
+                if (not os.path.isfile("%s.done" % work_unit_name(temp_dir, u))) ]
+    if (len(missing) > 0):
+        print "%d of %d work units haven't been done yet, including unit %d." % (len(missing), len(work['units']),
+                                                                                 missing[0])
+        lock_name = "%s.lock" % work_unit_name(temp_dir, missing[0])
+        if (os.path.isfile(lock_name)):
+            with open(lock_name, "r") as fp:
+                print "It was claimed by the process on the machine listed in %s: %s" % (lock_name, fp.read().strip())
+            print "If that process has stopped, remove the lock file and run another worker."
+        sys.exit()
+    if (os.path.abspath(work['dataset']) != os.path.abspath(args['<dataset>'])):
+        print "WARNING: the work was planned for %s, but the dataset given is %s." % (work['dataset'],
+                                                                                     args['<dataset>'])
+    manifest = manifest_name(temp_dir)
+    chop_numbers = [ tuple(c) for c in work['segments'] ]
+    print "Merging the segments from %d work units" % len(work['units'])
+    mix_segments(args, chop_numbers, work['out'], work['stage_dir'], manifest,
+                 read_manifest(manifest), work['cycle_time'])
+
+def requested_sources(args):
+    # Get the parameters of the sources we're adding, or None if the user
+    # has given a uvgen source file instead.
+    if (args['--catalogue'] is not None):
+        sources = read_catalogue(args['--catalogue'])
+        print "     Found %d sources in the catalogue" % len(sources)
+        return sources
+    if (args['--source-file'] is None):
+        return sources_from_arguments(args)
+    return None
+
+def add_source(args):
+    adder = SourceAdder(args)
+
+    # We generate a dataset for each source that we found.
+    # In general, if there is more than one source in the dataset, it's probably
+    # a mosaic.
+
+    # First, print a warning if the user has specified a source file (which only
+    # supports offsets) if there is more than one source.
+    if ((len(adder.metadata['index']['sources']) > 1) and (args['--source-file'] is not None)):
+        print "WARNING: multiple sources present, but a source file has been given."
+        print "         This is probably not what you wanted, but we continue in case it is."
     
-if __name__ == '__main__':
-    arguments = docopt(__doc__, version="Miriad Source Adding Helper 1.0")
+
+    # Get the parameters of the sources we're adding.
+    new_sources = requested_sources(args)
+
+    if (args['--show-plan']):
+        print_plan(adder.plan)
+        return
+    if (args['--shard'] == "plan"):
+        write_work_manifest(args, adder.metadata, adder.plan, new_sources)
+        return
+    adder.add(new_sources, args['--out'])
+    
+def source_from_columns(els):
+    # Make a source from the columns "RA DEC FLUX BMAJ,BMIN,BPA ALPHA", or
+    # return None if they aren't correctly specified.
+    if (len(els) != 5):
+        return None
+    szel = els[3].split(",")
+    if (len(szel) != 3):
+        return None
+    try:
+        return { 'ra': els[0], 'dec': els[1], 'flux': float(els[2]),
+                 'bmaj': float(szel[0]), 'bmin': float(szel[1]),
+                 'bpa': float(szel[2]), 'alpha': float(els[4]) }
+    except ValueError:
+        return None
+
+def read_realisations(filename):
+    # Read a file of source realisations. Each line describes a single
+    # source, as "NAME RA DEC FLUX BMAJ,BMIN,BPA ALPHA", and all the lines
+    # with the same NAME make up one realisation. We return a list of
+    # (name, sources) in the order the realisations first appear.
+    realisations = []
+    realisation_sources = {}
+    with open(filename, "r") as fp:
+        lines = fp.readlines()
+    for i in xrange(0, len(lines)):
+        els = lines[i].split("#")[0].split()
+        if (len(els) == 0):
+            continue
+        source = source_from_columns(els[1:])
+        if (source is None):
+            print "ERROR: line %d of the realisations file is not correctly specified" % (i + 1)
+            sys.exit()
+        if (els[0] not in realisation_sources):
+            realisation_sources[els[0]] = []
+            realisations.append((els[0], realisation_sources[els[0]]))
+        realisation_sources[els[0]].append(source)
+    return realisations
+
+def read_catalogue(filename):
+    # Read a catalogue of sources to add. Each line describes a single
+    # source, as "RA DEC FLUX BMAJ,BMIN,BPA ALPHA".
+    sources = []
+    with open(filename, "r") as fp:
+        for (i, line) in enumerate(fp):
+            els = line.split("#")[0].split()
+            if (len(els) == 0):
+                continue
+            source = source_from_columns(els)
+            if (source is None):
+                print "ERROR: line %d of the catalogue is not correctly specified" % (i + 1)
+                sys.exit()
+            sources.append(source)
+    return sources
+
+def batch_add_sources(args):
+    # Make a mixed dataset for each of the source realisations in a file.
+    # Everything that doesn't depend on the sources is only worked out once.
+    realisations = read_realisations(args['--realisations'])
+    print "Found %d source realisations" % len(realisations)
+    adder = SourceAdder(args)
+
+    start_time = time.time()
+    failed = []
+    for r in xrange(0, len(realisations)):
+        (name, sources) = realisations[r]
+        out_name = "%s.%s" % (args['--out'], name)
+        print "Realisation %s (%d / %d)" % (name, (r + 1), len(realisations))
+        try:
+            # Each realisation gets its own directory for its intermediate files.
+            adder.add(sources, out_name, "%s/realisation_%s" % (args['--temp-dir'], name))
+        except (Exception, SystemExit) as e:
+            # Don't let one realisation stop all the others.
+            print "ERROR: realisation %s failed: %s" % (name, e)
+            failed.append(name)
+    elapsed = time.time() - start_time
+
+    num_done = len(realisations) - len(failed)
+    rate = 0.
+    if (elapsed > 0):
+        rate = num_done * 3600. / elapsed
+    print "Completed %d of %d realisations in %.1f seconds (%.1f realisations per hour)" % (num_done, len(realisations), elapsed, rate)
+    if (len(failed) > 0):
+        print "These realisations failed: %s" % ", ".join(failed)
+
+def dataset_arguments(args, dataset_name):
+    # The arguments for one of several datasets. Each dataset gets its own
+    # temporary directory, and its own output named after it.
+    dataset_args = dict(args)
+    dataset_args['<dataset>'] = dataset_name
+    basename = os.path.basename(os.path.normpath(dataset_name))
+    if (args['--out'] is None):
+        dataset_args['--out'] = "%s.sourceadd" % dataset_name
+    else:
+        dataset_args['--out'] = "%s.%s" % (args['--out'], basename)
+    dataset_args['--temp-dir'] = "%s/dataset_%s" % (args['--temp-dir'], basename)
+    if (not os.path.isdir(dataset_args['--temp-dir'])):
+        os.makedirs(dataset_args['--temp-dir'])
+    return dataset_args
+
+def multi_add_sources(args):
+    # Add the same sources to each of several datasets. The segments for all
+    # the datasets are generated by a single pool of processes, and the
+    # source files for pointings that several datasets share are only made
+    # once.
+    new_sources = requested_sources(args)
+    datasets = [ dataset_arguments(args, dataset_name) for dataset_name in args['<dataset>'] ]
+    if (args['--engine'] == "direct"):
+        for dataset_args in datasets:
+            print "Dataset %s" % dataset_args['<dataset>']
+            SourceAdder(dataset_args).add(new_sources, dataset_args['--out'])
+        return
+
+    # Plan each dataset, sharing the telescopes and source files between them.
+    shared = prepare_sources(args, new_sources)
+    telescopes = {}
+    runs = []
+    all_tasks = []
+    all_completed = {}
+    num_segments = 0
+    for dataset_args in datasets:
+        print "Dataset %s" % dataset_args['<dataset>']
+        metadata = get_dataset_metadata(dataset_args['<dataset>'], metadata_cache_dir(dataset_args))
+        coordinates = metadata['telescope_coordinates']
+        telescope_key = (coordinates['latitude'], coordinates['longitude'])
+        if (telescope_key not in telescopes):
+            telescopes[telescope_key] = make_telescope(coordinates)
+        with profile_stage("plan"):
+            plan = plan_generation(dataset_args, metadata, telescopes[telescope_key])
+        if (args['--show-plan']):
+            print_plan(plan)
+            continue
+        work_dir = dataset_args['--temp-dir']
+        stage_dir = staging_dir(dataset_args, work_dir)
+        if (not os.path.isdir(stage_dir)):
+            os.makedirs(stage_dir)
+        manifest = manifest_name(work_dir)
+        if (args['--fresh'] and os.path.isfile(manifest)):
+            os.remove(manifest)
+        completed = read_manifest(manifest)
+        (group_tasks, chop_numbers) = make_generation_tasks(dataset_args, plan, new_sources,
+                                                            dataset_args['--out'], work_dir,
+                                                            stage_dir, manifest, shared)
+        runs.append({ 'args': dataset_args, 'chop_numbers': chop_numbers, 'stage_dir': stage_dir,
+                      'manifest': manifest, 'completed': completed,
+                      'cycle_time': metadata['cycle_time'] })
+        if have_concatenated(chop_numbers, stage_dir, completed):
+            print "  Reusing the concatenated segments from an earlier run"
+            continue
+        all_tasks.extend(group_tasks)
+        all_completed.update(completed)
+        num_segments += plan['num_segments']
+    if (args['--show-plan']):
+        return
+
+    # Generate the segments for all the datasets together.
+    print "Generating the segments for %d datasets" % len(runs)
+    for t in xrange(0, len(all_tasks)):
+        all_tasks[t]['number'] = t
+        all_tasks[t]['total'] = len(all_tasks)
+    generate_segments(args, all_tasks, all_completed, num_segments)
+
+    # Then mix each dataset in turn.
+    failed = []
+    for run in runs:
+        print "Mixing dataset %s" % run['args']['<dataset>']
+        try:
+            mix_segments(run['args'], run['chop_numbers'], run['args']['--out'], run['stage_dir'],
+                         run['manifest'], run['completed'], run['cycle_time'])
+        except (Exception, SystemExit) as e:
+            # Don't let one dataset stop all the others.
+            print "ERROR: dataset %s failed: %s" % (run['args']['<dataset>'], e)
+            failed.append(run['args']['<dataset>'])
+    if (len(failed) > 0):
+        print "These datasets failed: %s" % ", ".join(failed)
+
+def parse_arguments(argv=None):
+    # Read the command line (the script's own, unless we're given one) and
+    # check it makes sense. The problems we find are printed, and then we
+    # return None.
+    arguments = docopt(__doc__, argv=argv, version="Miriad Source Adding Helper 1.0")
+    if (arguments['--listen'] is not None):
+        # Each job brings its own command line.
+        return arguments
     valid = True
     # Do some existence checking.
-    if (('<dataset>' not in arguments) or
-        (not os.path.isdir(arguments['<dataset>']))):
-        print "No valid dataset found."
+    for dataset_name in arguments['<dataset>']:
+        if (not os.path.isdir(dataset_name)):
+            print "No valid dataset found at %s." % dataset_name
+            valid = False
+    if (len(arguments['<dataset>']) == 1):
+        arguments['<dataset>'] = arguments['<dataset>'][0]
+        if ((arguments['--out'] is None) and (valid == True)):
+            # Make a default.
+            arguments['--out'] = "%s.sourceadd" % arguments['<dataset>']
+    elif ((arguments['--realisations'] is not None) or (arguments['--shard'] is not None)):
+        print "Realisations and sharding can only be used with a single dataset."
         valid = False
-    if (('--out' not in arguments) and (valid == True)):
-        # Make a default.
-        arguments['--out'] = "%s.sourceadd" % arguments['<dataset>']
+    else:
+        # Each dataset's temporary directory and output are named after it.
+        basenames = [ os.path.basename(os.path.normpath(dataset_name))
+                      for dataset_name in arguments['<dataset>'] ]
+        for basename in sorted(set(basenames)):
+            if (basenames.count(basename) > 1):
+                print "More than one dataset is called %s; give each dataset a different name." % basename
+                valid = False
     # Check we have information to generate a source.
-    if (('--source-file' not in arguments) or (arguments['--source-file'] is None)):
+    if (arguments['--realisations'] is not None):
+        if ((arguments['--source-file'] is not None) or (len(arguments['--ra']) > 0)):
+            print "A realisations file was specified, but so were other sources."
+            valid = False
+        elif (not os.path.isfile(arguments['--realisations'])):
+            print "Specified realisations file cannot be found."
+            valid = False
+    elif (arguments['--catalogue'] is not None):
+        if ((arguments['--source-file'] is not None) or (len(arguments['--ra']) > 0)):
+            print "A catalogue was specified, but so were other sources."
+            valid = False
+        elif (not os.path.isfile(arguments['--catalogue'])):
+            print "Specified catalogue cannot be found."
+            valid = False
+    elif (('--source-file' not in arguments) or (arguments['--source-file'] is None)):
         if (('--ra' not in arguments) or ('--dec' not in arguments) or
             ('--flux' not in arguments) or ('--size' not in arguments) or
             ('--alpha' not in arguments)):
@@ -519,19 +2156,245 @@ if __name__ == '__main__':
             print "Not every new source is properly specified."
             valid = False
     else:
-        if (('--ra' in arguments) or ('--dec' in arguments) or
-            ('--flux' in arguments) or ('--size' in arguments) or
-            ('--alpha' in arguments)):
+        if ((len(arguments['--ra']) > 0) or (len(arguments['--dec']) > 0) or
+            (len(arguments['--flux']) > 0) or (len(arguments['--size']) > 0) or
+            (len(arguments['--alpha']) > 0)):
             print "A pre-made source file was specified, but so were new source parameters."
             valid = False
         elif (not os.path.isfile(arguments['--source-file'])):
             print "Specified source file cannot be found."
-            valid = false
+            valid = False
+    try:
+        if ((arguments['--source-radius'] is not None) and (float(arguments['--source-radius']) <= 0)):
+            raise ValueError
+    except ValueError:
+        print "The source radius must be a positive number of arcmin."
+        valid = False
+    if ((arguments['--source-radius'] is not None) and (arguments['--source-file'] is not None)):
+        # The positions in a source file are offsets from each pointing, so
+        # there's nothing to prune.
+        print "The source radius can't be used with a source file."
+        valid = False
+    # Check we know the engine.
+    if (arguments['--engine'] not in [ "uvgen", "direct" ]):
+        print "The engine must be either uvgen or direct."
+        valid = False
+    # Check we know the mixer.
+    if (arguments['--mixer'] not in [ "uvmodel", "stream" ]):
+        print "The mixer must be either uvmodel or stream."
+        valid = False
+    try:
+        if (float(arguments['--mix-memory']) <= 0):
+            raise ValueError
+    except ValueError:
+        print "The mixer memory must be a positive number of MB."
+        valid = False
+    # The direct engine, the streaming mixer and the uvw check read the visibilities themselves.
+    if (((arguments['--engine'] == "direct") or (arguments['--mixer'] == "stream") or
+         arguments['--check-uvw']) and (aipy is None)):
+        print "The direct engine, streaming mixer and uvw check need the aipy module, which could not be imported."
+        valid = False
+    try:
+        if (float(arguments['--uvw-tolerance']) <= 0):
+            raise ValueError
+    except ValueError:
+        print "The uvw tolerance must be a positive number."
+        valid = False
+    try:
+        if (float(arguments['--cache-size']) <= 0):
+            raise ValueError
+    except ValueError:
+        print "The segment cache size must be a positive number of MB."
+        valid = False
+    try:
+        if ((arguments['--max-scratch'] is not None) and (float(arguments['--max-scratch']) <= 0)):
+            raise ValueError
+    except ValueError:
+        print "The scratch space limit must be a positive number of MB."
+        valid = False
+    # Check we know the sharding step, and that it's only used for a single set of sources.
+    if (arguments['--shard'] is not None):
+        if (arguments['--shard'] not in [ "plan", "worker", "merge" ]):
+            print "The sharding step must be plan, worker or merge."
+            valid = False
+        elif ((arguments['--realisations'] is not None) or (arguments['--engine'] == "direct")):
+            print "Sharding can't be used with realisations or the direct engine."
+            valid = False
+        elif (arguments['--stage-dir'] is not None):
+            # Every host has to be able to see the segments, so they stay in
+            # the shared temporary directory.
+            print "Sharding can't be used with a staging directory."
+            valid = False
+    try:
+        if (float(arguments['--pointing-gap']) < 0):
+            raise ValueError
+    except ValueError:
+        print "The pointing gap must be a number of minutes, no less than 0."
+        valid = False
+    # Check the number of parallel jobs makes sense.
+    if ((not arguments['--jobs'].isdigit()) or (int(arguments['--jobs']) < 1)):
+        print "The number of jobs must be a positive integer."
+        valid = False
     # Check either the temp dir exists or can be made.
     if (not os.path.isdir(arguments['--temp-dir'])):
         os.makedirs(arguments['--temp-dir'])
-    if (valid == True):
+    if ((arguments['--segment-cache'] is not None) and
+        (not os.path.isdir(arguments['--segment-cache']))):
+        os.makedirs(arguments['--segment-cache'])
+    if ((arguments['--stage-dir'] is not None) and
+        (not os.path.isdir(arguments['--stage-dir']))):
+        os.makedirs(arguments['--stage-dir'])
+    if (valid == False):
+        return None
+    return arguments
+
+class SourceAdder(object):
+    # Everything about adding sources to a dataset that doesn't depend on the
+    # sources: the arguments, the dataset's metadata, the telescope and the
+    # plan of the segments to generate. These are worked out once, and each
+    # call to add then only does the work that depends on the sources.
+    # For example:
+    #   adder = SourceAdder(parse_arguments([ "--temp-dir", "tmp", "real.5500" ]))
+    #   adder.add(read_catalogue("sources.txt"), "mixed.5500")
+    def __init__(self, args):
+        self.args = args
+        self.metadata = None
+        self.telescope = None
+        self.plan = None
+        if (args['--engine'] != "direct"):
+            self.metadata = get_dataset_metadata(args['<dataset>'], metadata_cache_dir(args))
+            self.telescope = make_telescope(self.metadata['telescope_coordinates'])
+            with profile_stage("plan"):
+                self.plan = plan_generation(args, self.metadata, self.telescope)
+
+    def add(self, sources, out_name, work_dir=None):
+        # Mix the sources into the dataset as out_name, with the intermediate
+        # files in work_dir (by default, the temporary directory). If sources
+        # is None, we use the user's source file instead.
+        if (self.args['--engine'] == "direct"):
+            if (sources is None):
+                sources = read_source_file(self.args['--source-file'])
+            radius = None
+            if (self.args['--source-radius'] is not None):
+                radius = math.radians(float(self.args['--source-radius']) / 60.)
+            with profile_stage("direct_mix", out=out_name):
+                direct_mix(self.args['<dataset>'], sources, out_name, radius)
+            print "Process complete. The mixed dataset can be found at %s" % out_name
+            return
+        if (work_dir is None):
+            work_dir = self.args['--temp-dir']
+        if (not os.path.isdir(work_dir)):
+            os.makedirs(work_dir)
+        realise_sources(self.args, self.metadata, self.plan, sources, out_name, work_dir)
+
+def adder_key(args):
+    # What a SourceAdder depends on. A job with the same key can use the same
+    # SourceAdder, as long as the dataset hasn't changed.
+    return json.dumps([ os.path.abspath(args['<dataset>']),
+                        [ args[option] for option in [ '--temp-dir', '--test', '--per-pointing',
+                                                       '--pointing-gap', '--exact-times', '--engine',
+                                                       '--no-cache' ] ] ])
+
+def run_job(adders, argv):
+    # Run a job sent to the server: argv is a command line as the script
+    # would be given, for a single dataset. Returns the reply to send back.
+    args = parse_arguments(argv)
+    if (args is None):
+        return { 'status': "error", 'message': "the arguments aren't valid" }
+    if (isinstance(args['<dataset>'], list) or (args['--listen'] is not None) or
+        (args['--realisations'] is not None) or (args['--shard'] is not None)):
+        return { 'status': "error",
+                 'message': "jobs can only add one set of sources to a single dataset" }
+    key = adder_key(args)
+    dataset_key = dataset_cache_key(args['<dataset>'])
+    if ((key not in adders) or (adders[key]['dataset_key'] != dataset_key)):
+        # A changed dataset replaces the SourceAdder we had for it.
+        adders[key] = { 'dataset_key': dataset_key, 'adder': SourceAdder(args) }
+    else:
+        print "     Using the plan from an earlier job"
+        # The options that don't affect the plan can change between jobs.
+        adders[key]['adder'].args = args
+    adders[key]['adder'].add(requested_sources(args), args['--out'])
+    return { 'status': "ok", 'out': args['--out'] }
+
+def serve(socket_name):
+    # Run jobs sent to a Unix socket, one at a time, keeping a SourceAdder
+    # for each dataset so later jobs don't need to look at it again. Each
+    # connection sends one JSON line, { "argv": [ ... ] }, and gets one JSON
+    # line back, with "status" either "ok" or "error".
+    if (os.path.exists(socket_name)):
+        os.remove(socket_name)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_name)
+    server.listen(16)
+    print "Waiting for jobs on %s" % socket_name
+    adders = {}
+    try:
+        while True:
+            (connection, address) = server.accept()
+            stream = connection.makefile("rw")
+            start_time = time.time()
+            try:
+                request = json.loads(stream.readline())
+                # docopt only treats byte strings as single arguments.
+                argv = [ arg.encode("utf-8") for arg in request['argv'] ]
+                print "Job: %s" % " ".join(argv)
+                reply = run_job(adders, argv)
+            except (Exception, SystemExit) as e:
+                # Don't let one job stop the server. Most problems have
+                # already been printed, and then the job exits with no message.
+                reply = { 'status': "error", 'message': (str(e) or "see the server's output") }
+            reply['seconds'] = time.time() - start_time
+            if (reply['status'] != "ok"):
+                print "ERROR: the job failed: %s" % reply['message']
+            try:
+                stream.write("%s\n" % json.dumps(reply))
+                stream.flush()
+            except socket.error:
+                print "WARNING: the client went away before the job finished."
+            stream.close()
+            connection.close()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    os.remove(socket_name)
+
+def submit_job(socket_name, argv):
+    # Send a job to a server started with --listen, and wait for the reply.
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_name)
+    stream = client.makefile("rw")
+    stream.write("%s\n" % json.dumps({ 'argv': argv }))
+    stream.flush()
+    reply = json.loads(stream.readline())
+    stream.close()
+    client.close()
+    return reply
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if ((arguments is not None) and (arguments['--listen'] is not None)):
+        serve(arguments['--listen'])
+    elif (arguments is not None):
         print arguments
-        add_source(arguments)
+        if (arguments['--profile']):
+            profile_trace_name = "%s/profile.jsonl" % arguments['--temp-dir']
+            if (os.path.isfile(profile_trace_name)):
+                os.remove(profile_trace_name)
+        with profile_stage("total", out=arguments['--out']):
+            if (isinstance(arguments['<dataset>'], list)):
+                multi_add_sources(arguments)
+            elif (arguments['--shard'] == "worker"):
+                shard_worker(arguments)
+            elif (arguments['--shard'] == "merge"):
+                shard_merge(arguments)
+            elif (arguments['--realisations'] is not None):
+                batch_add_sources(arguments)
+            elif (arguments['--engine'] == "direct"):
+                SourceAdder(arguments).add(requested_sources(arguments), arguments['--out'])
+            else:
+                add_source(arguments)
+        if (arguments['--profile']):
+            print_profile_summary(profile_trace_name)
 
     
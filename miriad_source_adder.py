@@ -0,0 +1,9 @@
+# The source adder as a module that can be imported, which the script
+# itself can't be because of the hyphens in its name. For example:
+#   from miriad_source_adder import SourceAdder, parse_arguments, read_catalogue
+import imp
+import os
+
+imp.load_source("miriad_source_adder_script",
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "miriad-source-adder.py"))
+from miriad_source_adder_script import *